@@ -0,0 +1,387 @@
+"""
+In-process stand-in for the parts of the notion-py client used by `libnotion`,
+`libsync`, and `libregistry`, so the channel sync tasks can be benchmarked
+without talking to notion.so. The fake keeps a "server" copy of all records and
+a local record store like notion-py does: reads are served from the local store
+and only records that are missing (or explicitly refreshed) cost a request.
+Every simulated request sleeps for `latency` seconds and is counted by kind:
+  - `loadPageChunk`: fetch of a block or collection view not in the local store
+  - `syncRecordValues`: `refresh_records` or fetch of a missing record
+  - `queryCollection`: `collection.get_rows()` or `collection.query()`
+  - `submitTransaction`: each write, or each atomic transaction with writes
+All the client methods called are also counted in `client.counts['ops']`.
+Row properties are stored in the records keyed by property name (not by
+schema property id as notion.so does), with dates stored as ISO strings.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import time
+import uuid
+
+
+REQUEST_KINDS = ['loadPageChunk', 'syncRecordValues', 'queryCollection', 'submitTransaction']
+
+
+def new_record_id():
+    return str(uuid.uuid4())
+
+
+def encode_property_value(value):
+    if isinstance(value, datetime):
+        return {'type': 'date', 'start_date': value.isoformat()}
+    return value
+
+
+def decode_property_value(value):
+    if isinstance(value, dict) and value.get('type') == 'date':
+        return datetime.fromisoformat(value['start_date'])
+    return value
+
+
+def get_path(data, path):
+    """
+    Returns the value at the dotted `path` (e.g. 'format.table_wrap') in `data`.
+    """
+    for key in path.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+
+# FAKE CLIENT
+################################################################################
+
+class FakeNotionClient(object):
+    """
+    Fake `notion.client.NotionClient` that counts operations and requests and
+    waits `latency` seconds for each simulated request.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._server = {'block': {}, 'collection': {}, 'collection_view': {}}
+        self._store = FakeRecordStore()
+        self._lock = threading.RLock()
+        self._transaction_ops = None   # list of pending ops while in an atomic transaction
+        self.reset_counts()
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {'ops': {}, 'requests': dict((kind, 0) for kind in REQUEST_KINDS)}
+
+    def clear_store(self):
+        """
+        Forget all the records in the local store, like a newly created client.
+        """
+        self._store = FakeRecordStore()
+
+    def num_requests(self):
+        return sum(self.counts['requests'].values())
+
+    def _count_op(self, name):
+        with self._lock:
+            self.counts['ops'][name] = self.counts['ops'].get(name, 0) + 1
+
+    def _request(self, kind):
+        with self._lock:
+            self.counts['requests'][kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # Records
+    ############################################################################
+
+    def get_record_data(self, table, id, force_refresh=False):
+        self._count_op('get_record_data')
+        if force_refresh or self._store.get(table, id) is None:
+            self._request('syncRecordValues')
+            self._load_records(table, [id])
+        return self._store.get(table, id)
+
+    def refresh_records(self, **kwargs):
+        """
+        Reload the records given as `table=[ids]` keyword arguments in one request.
+        """
+        self._count_op('refresh_records')
+        self._request('syncRecordValues')
+        for table, ids in kwargs.items():
+            self._load_records(table, ids)
+
+    def _load_records(self, table, ids):
+        with self._lock:
+            for id in ids:
+                if id in self._server[table]:
+                    self._store._update_record(table, id, value=dict(self._server[table][id]))
+
+    def _write(self, table, id, updates):
+        """
+        Apply `updates` (dict of field --> value) to the record on the "server"
+        and in the local store. Writes made outside of an atomic transaction
+        are submitted immediately, one request per write.
+        """
+        self._count_op('write')
+        with self._lock:
+            record = self._server[table].setdefault(id, {'id': id})
+            record.update(updates)
+            if table == 'block':
+                record['last_edited_time'] = int(time.time() * 1000)
+            self._store._update_record(table, id, value=dict(record))
+            in_transaction = self._transaction_ops is not None
+            if in_transaction:
+                self._transaction_ops.append((table, id))
+        if not in_transaction:
+            self._request('submitTransaction')
+
+    @contextmanager
+    def as_atomic_transaction(self):
+        """
+        Group the writes made inside the context into a single request. Like in
+        notion-py the pending operations are stored on the client.
+        """
+        self._count_op('as_atomic_transaction')
+        self._transaction_ops = []
+        try:
+            yield
+        finally:
+            ops, self._transaction_ops = self._transaction_ops, None
+            if ops:
+                self._request('submitTransaction')
+
+    def create_record(self, table, parent, **kwargs):
+        self._count_op('create_record')
+        id = new_record_id()
+        record = {'alive': True, 'parent_id': parent.id, 'parent_table': parent._table}
+        record.update(kwargs)
+        self._write(table, id, record)
+        return id
+
+    # Blocks and collections
+    ############################################################################
+
+    def get_block(self, id):
+        self._count_op('get_block')
+        if self._store.get('block', id) is None:
+            self._request('loadPageChunk')
+            self._load_records('block', [id])
+        data = self._store.get('block', id)
+        if data is None:
+            return None
+        if data.get('parent_table') == 'collection':
+            return FakeRow(self, id)
+        return FakeBlock(self, id)
+
+    def get_collection(self, collection_id):
+        self._count_op('get_collection')
+        if self._store.get('collection', collection_id) is None:
+            self._request('syncRecordValues')
+            self._load_records('collection', [collection_id])
+        return FakeCollection(self, collection_id)
+
+    def get_collection_view(self, url_or_id, collection=None):
+        """
+        Accepts a view id or a notion URL with the view id in its `v=` parameter.
+        """
+        self._count_op('get_collection_view')
+        view_id = url_or_id.split('v=')[1].split('&')[0] if 'v=' in url_or_id else url_or_id
+        if self._store.get('collection_view', view_id) is None:
+            self._request('loadPageChunk')
+            self._load_records('collection_view', [view_id])
+            view_data = self._store.get('collection_view', view_id) or {}
+            self._load_records('collection', [view_data.get('collection_id')])
+        if collection is None:
+            view_data = self._store.get('collection_view', view_id)
+            collection = FakeCollection(self, view_data['collection_id'])
+        return FakeCollectionView(self, view_id, collection)
+
+    def create_collection(self, schema, title=''):
+        """
+        Create a collection with `schema` (dict of property name --> property
+        info with a `type` key) inside a new page and a table view for it.
+        Returns the FakeCollectionView. Not part of the notion-py API.
+        """
+        page_id = new_record_id()
+        self._write('block', page_id, {'id': page_id, 'type': 'collection_view_page', 'alive': True,
+                                       'properties': {'title': title}})
+        collection_id = new_record_id()
+        self._write('collection', collection_id, {'id': collection_id, 'parent_id': page_id,
+                                                  'parent_table': 'block', 'schema': schema,
+                                                  'name': title, 'format': {}})
+        view_id = new_record_id()
+        self._write('collection_view', view_id, {'id': view_id, 'type': 'table', 'parent_id': page_id,
+                                                 'parent_table': 'block', 'collection_id': collection_id,
+                                                 'format': {}})
+        self._write('block', page_id, {'collection_id': collection_id, 'view_ids': [view_id]})
+        return self.get_collection_view(view_id)
+
+
+class FakeRecordStore(object):
+    """
+    Local record store of the fake client (the `_store` of notion-py clients).
+    """
+
+    def __init__(self):
+        self._values = {'block': {}, 'collection': {}, 'collection_view': {}}
+        self._lock = threading.Lock()
+
+    def get(self, table, id):
+        with self._lock:
+            return self._values[table].get(id)
+
+    def _update_record(self, table, id, value=None):
+        with self._lock:
+            if value is None:
+                self._values[table].pop(id, None)
+            else:
+                self._values[table][id] = value
+
+
+
+# FAKE RECORDS
+################################################################################
+
+class FakeRecord(object):
+    _table = None
+
+    def __init__(self, client, id):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, 'id', id)
+
+    def get(self, path=None):
+        data = self._client._store.get(self._table, self.id) or {}
+        if path is None:
+            return data
+        return get_path(data, path)
+
+    def set(self, path, value):
+        self._client._count_op('set')
+        key = path.split('.')[0]
+        if key == path:
+            self._client._write(self._table, self.id, {key: value})
+        else:
+            data = dict(self.get(key) or {})
+            data[path.split('.', 1)[1]] = value
+            self._client._write(self._table, self.id, {key: data})
+
+    def __repr__(self):
+        return '<{} id={}>'.format(type(self).__name__, self.id)
+
+
+class FakeBlock(FakeRecord):
+    _table = 'block'
+
+    @property
+    def type(self):
+        return self.get('type')
+
+    @property
+    def title(self):
+        return (self.get('properties') or {}).get('title', '')
+
+    @property
+    def collection(self):
+        collection_id = self.get('collection_id')
+        return self._client.get_collection(collection_id) if collection_id else None
+
+    @property
+    def children(self):
+        return [self._client.get_block(child_id) for child_id in (self.get('content') or [])]
+
+
+class FakeRow(FakeBlock):
+    """
+    Fake `CollectionRowBlock`. Properties are read with `get_property` or as
+    attributes, and written with `set_property` or by assigning the attribute.
+    """
+
+    @property
+    def collection(self):
+        return FakeCollection(self._client, self.get('parent_id'))
+
+    @property
+    def schema(self):
+        return self.collection.get('schema') or {}
+
+    @property
+    def title(self):
+        return self.get_property('title') or ''
+
+    def get_property(self, name):
+        self._client._count_op('get_property')
+        if (self.schema.get(name) or {}).get('type') == 'last_edited_time':
+            return datetime.fromtimestamp(self.get('last_edited_time') / 1000.0)
+        return decode_property_value((self.get('properties') or {}).get(name))
+
+    def get_all_properties(self):
+        return dict((name, self.get_property(name)) for name in self.schema)
+
+    def set_property(self, name, value):
+        self._client._count_op('set_property')
+        properties = dict(self.get('properties') or {})
+        properties[name] = encode_property_value(value)
+        self._client._write('block', self.id, {'properties': properties})
+
+    def __getattr__(self, name):
+        if not name.startswith('_') and name in self.schema:
+            return self.get_property(name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_') and name in self.schema:
+            self.set_property(name, value)
+        else:
+            object.__setattr__(self, name, value)
+
+
+class FakeCollection(FakeRecord):
+    _table = 'collection'
+
+    @property
+    def name(self):
+        return self.get('name')
+
+    def _get_row_ids(self, filter=None):
+        since = None
+        for condition in (filter or []):
+            if condition.get('comparator') == 'date_is_on_or_after':
+                start_date = condition['value']['value']['start_date']
+                since = time.mktime(datetime.strptime(start_date, '%Y-%m-%d').timetuple()) * 1000
+        with self._client._lock:
+            return [id for id, data in self._client._server['block'].items()
+                    if data.get('parent_id') == self.id and data.get('parent_table') == 'collection'
+                    and data.get('alive', True)
+                    and (since is None or data.get('last_edited_time', 0) >= since)]
+
+    def get_rows(self):
+        self._client._count_op('get_rows')
+        return self.query()
+
+    def query(self, filter=None):
+        """
+        Returns the rows of the collection, only the rows edited since the date
+        of a `date_is_on_or_after` condition when `filter` has one.
+        """
+        self._client._count_op('query')
+        self._client._request('queryCollection')
+        row_ids = self._get_row_ids(filter=filter)
+        self._client._load_records('block', row_ids)
+        return [FakeRow(self._client, row_id) for row_id in row_ids]
+
+    def add_row(self, **kwargs):
+        self._client._count_op('add_row')
+        row_id = new_record_id()
+        properties = dict((name, encode_property_value(value)) for name, value in kwargs.items())
+        self._client._write('block', row_id, {'id': row_id, 'type': 'page', 'alive': True,
+                                              'parent_id': self.id, 'parent_table': 'collection',
+                                              'properties': properties, 'content': []})
+        return FakeRow(self._client, row_id)
+
+
+class FakeCollectionView(FakeRecord):
+    _table = 'collection_view'
+
+    def __init__(self, client, id, collection):
+        super(FakeCollectionView, self).__init__(client, id)
+        object.__setattr__(self, 'collection', collection)
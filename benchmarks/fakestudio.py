@@ -0,0 +1,294 @@
+"""
+Offline stand-in for the Studio API endpoints used by `libstudio.StudioApi`,
+serving a synthetic channel so tree fetches and bulk edits can be benchmarked
+without touching a real Studio server. Run it with:
+
+    python -m benchmarks.fakestudio --nodes 5000 --fanout 10 --latency 0.05
+
+then point StudioApi to http://127.0.0.1:8080 (the DEFAULT_STUDIO_URL).
+"""
+import argparse
+import copy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+
+
+DEFAULT_PORT = 8080
+DEFAULT_NUM_NODES = 1000
+DEFAULT_FANOUT = 10
+LEAF_KINDS = ['video', 'document', 'exercise', 'audio', 'html5']
+LANGUAGES = ['en', 'es', 'fr', 'ar', 'sw']
+LICENSES = [
+    {'id': 1, 'license_name': 'CC BY', 'exists': True},
+    {'id': 2, 'license_name': 'CC BY-SA', 'exists': True},
+    {'id': 3, 'license_name': 'CC BY-NC', 'exists': True},
+    {'id': 8, 'license_name': 'Public Domain', 'exists': True},
+]
+
+
+# SYNTHETIC CHANNEL
+################################################################################
+
+class FakeStudio(object):
+    """
+    In-memory synthetic channel with `num_nodes` nodes in its main tree, where
+    each topic has `fanout` children. Nodes are stored flat (children as lists
+    of ids) the same way `/api/get_nodes_by_ids_complete/` returns them.
+    """
+
+    def __init__(self, num_nodes=DEFAULT_NUM_NODES, fanout=DEFAULT_FANOUT, seed=42):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.channel_id = self._new_id()
+        main_root_id = self._build_tree(num_nodes, fanout)
+        trash_root_id = self._add_node(None, 'topic', 'Trash')
+        self.channel = {
+            'id': self.channel_id,
+            'name': 'Synthetic channel',
+            'description': 'Channel with {} nodes and fanout {}'.format(num_nodes, fanout),
+            'language': 'en',
+            'version': 1,
+            'public': False,
+            'primary_token': 'abcde-fghij',
+            'created': '2019-01-01T00:00:00Z',
+            'source_id': 'synthetic',
+            'published_size': 0,
+            'ricecooker_version': None,
+            'main_tree': {'id': main_root_id},
+            'staging_tree': None,
+            'trash_tree': {'id': trash_root_id},
+        }
+
+    def _new_id(self):
+        return '%032x' % self.rng.getrandbits(128)
+
+    def _add_node(self, parent_id, kind, title):
+        studio_id = self._new_id()
+        node = {
+            'id': studio_id,
+            'node_id': self._new_id(),
+            'content_id': self._new_id(),
+            'parent': parent_id,
+            'kind': kind,
+            'title': title,
+            'description': 'Description of ' + title,
+            'language': self.rng.choice(LANGUAGES),
+            'license': self.rng.choice(LICENSES)['id'],
+            'tags': [],
+            'prerequisite': [],
+            'files': [{'checksum': self._new_id(), 'file_size': self.rng.randint(1000, 10**7)}],
+            'metadata': {},
+        }
+        if kind == 'topic':
+            node['children'] = []
+            node['files'] = []
+        self.nodes[studio_id] = node
+        if parent_id is not None:
+            self.nodes[parent_id]['children'].append(studio_id)
+        return studio_id
+
+    def _build_tree(self, num_nodes, fanout):
+        """
+        Build the tree breadth-first: each topic gets `fanout` children, which
+        are topics as long as more topics are needed to reach `num_nodes`.
+        """
+        root_id = self._add_node(None, 'topic', 'Channel root')
+        num_topics_needed = max(1, -(-(num_nodes - 1) // fanout))   # ceil division
+        num_topics, count = 1, 1
+        queue = [root_id]
+        while queue and count < num_nodes:
+            parent_id = queue.pop(0)
+            for i in range(fanout):
+                if count >= num_nodes:
+                    break
+                if num_topics < num_topics_needed:
+                    child_id = self._add_node(parent_id, 'topic', 'Topic {}'.format(count))
+                    queue.append(child_id)
+                    num_topics += 1
+                else:
+                    kind = self.rng.choice(LEAF_KINDS)
+                    self._add_node(parent_id, kind, '{} {}'.format(kind.title(), count))
+                count += 1
+        self._update_metadata(root_id)
+        return root_id
+
+    def _update_metadata(self, studio_id):
+        node = self.nodes[studio_id]
+        total_count, resource_size = 1, sum(f['file_size'] for f in node['files'])
+        for child_id in node.get('children', []):
+            self._update_metadata(child_id)
+            child_metadata = self.nodes[child_id]['metadata']
+            total_count += child_metadata['total_count']
+            resource_size += child_metadata['resource_size']
+        node['metadata'] = {'total_count': total_count, 'resource_size': resource_size}
+
+    # Endpoints
+    ############################################################################
+
+    def get_nodes(self, studio_ids):
+        with self.lock:
+            return [self.nodes[studio_id] for studio_id in studio_ids if studio_id in self.nodes]
+
+    def put_contentnodes(self, datas):
+        updated = []
+        with self.lock:
+            for data in datas:
+                node = self.nodes.get(data['id'])
+                if node is None:
+                    continue
+                for key, value in data.items():
+                    if key not in ['id', 'children', 'parent']:
+                        node[key] = value
+                updated.append(node)
+        return updated
+
+    def move_nodes(self, datas, target_parent):
+        moved = []
+        with self.lock:
+            for data in datas:
+                node = self.nodes.get(data['id'])
+                if node is None or target_parent not in self.nodes:
+                    continue
+                if node['parent'] in self.nodes:
+                    self.nodes[node['parent']]['children'].remove(node['id'])
+                node['parent'] = target_parent
+                self.nodes[target_parent]['children'].append(node['id'])
+                moved.append(node)
+        return moved
+
+    def duplicate_nodes(self, node_ids, target_parent):
+        copies = []
+        with self.lock:
+            for studio_id in node_ids:
+                if studio_id in self.nodes and target_parent in self.nodes:
+                    copies.append(self._copy_subtree(studio_id, target_parent))
+        return copies
+
+    def _copy_subtree(self, studio_id, target_parent):
+        node_copy = copy.deepcopy(self.nodes[studio_id])
+        node_copy['id'] = self._new_id()
+        node_copy['node_id'] = self._new_id()   # like Studio, copies are new nodes
+        node_copy['source_node_id'] = self.nodes[studio_id]['node_id']
+        node_copy['original_source_node_id'] = self.nodes[studio_id].get('original_source_node_id') \
+            or self.nodes[studio_id]['node_id']
+        node_copy['parent'] = target_parent
+        self.nodes[node_copy['id']] = node_copy
+        self.nodes[target_parent]['children'].append(node_copy['id'])
+        if 'children' in node_copy:
+            child_ids, node_copy['children'] = node_copy['children'], []
+            for child_id in child_ids:
+                self._copy_subtree(child_id, node_copy['id'])
+        return node_copy
+
+
+
+# HTTP SERVER
+################################################################################
+
+def make_handler(studio, latency=0.0):
+    """
+    Returns a request handler class serving `studio` (a FakeStudio) that waits
+    `latency` seconds before answering each request.
+    """
+
+    class FakeStudioHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'   # keep-alive connections
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length else b''
+            if 'json' in self.headers.get('Content-Type', ''):
+                return json.loads(body.decode('utf-8'))
+            return None
+
+        def _send_json(self, data, status=200, extra_headers=None):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            path = self.path.split('?')[0]
+            if path == '/accounts/login/':
+                self._send_json({}, extra_headers={'Set-Cookie': 'csrftoken=fakecsrftoken; Path=/'})
+            elif path == '/api/license':
+                self._send_json(LICENSES)
+            elif path.startswith('/api/channel/'):
+                channel_id = path[len('/api/channel/'):]
+                if channel_id == studio.channel_id:
+                    self._send_json(studio.channel)
+                else:
+                    self._send_json({'detail': 'Not found.'}, status=404)
+            elif path.startswith('/api/get_nodes_by_ids_complete/'):
+                studio_ids = path[len('/api/get_nodes_by_ids_complete/'):].split(',')
+                self._send_json(studio.get_nodes(studio_ids))
+            else:
+                self._send_json({'detail': 'Not found.'}, status=404)
+
+        def do_POST(self):
+            if latency:
+                time.sleep(latency)
+            path = self.path.split('?')[0]
+            data = self._read_json()
+            if path == '/accounts/login/':
+                self._send_json({})
+            elif path == '/api/move_nodes/':
+                self._send_json(studio.move_nodes(data['nodes'], data['target_parent']))
+            elif path == '/api/duplicate_nodes/':
+                self._send_json(studio.duplicate_nodes(data['node_ids'], data['target_parent']))
+            else:
+                self._send_json({'detail': 'Not found.'}, status=404)
+
+        def do_PUT(self):
+            if latency:
+                time.sleep(latency)
+            path = self.path.split('?')[0]
+            data = self._read_json()
+            if path == '/api/contentnode':
+                self._send_json(studio.put_contentnodes(data))
+            else:
+                self._send_json({'detail': 'Not found.'}, status=404)
+
+    return FakeStudioHandler
+
+
+def make_server(studio, port=DEFAULT_PORT, latency=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(studio, latency=latency))
+    server.daemon_threads = True
+    return server
+
+
+def serve(num_nodes=DEFAULT_NUM_NODES, fanout=DEFAULT_FANOUT, latency=0.0, port=DEFAULT_PORT, ready=None):
+    """
+    Build a FakeStudio and serve it forever. If `ready` (a multiprocessing queue)
+    is given, the channel_id is put on it once the server is listening.
+    """
+    studio = FakeStudio(num_nodes=num_nodes, fanout=fanout)
+    server = make_server(studio, port=port, latency=latency)
+    if ready is not None:
+        ready.put(studio.channel_id)
+    print('Serving fake Studio channel_id={} on http://127.0.0.1:{}'.format(studio.channel_id, port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline stand-in for the Studio API.')
+    parser.add_argument('--nodes', type=int, default=DEFAULT_NUM_NODES, help='number of nodes in the main tree')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT, help='number of children of each topic')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    serve(num_nodes=args.nodes, fanout=args.fanout, latency=args.latency, port=args.port)
@@ -0,0 +1,203 @@
+"""
+Benchmarks for the "Studio Channels" sync (`libsync.sync_channels_info` as
+run by `fab update_notion_channels_info`) and the channel registry update used
+by `fab export_channels_info`, run against synthetic boards in the fake Notion
+client of `benchmarks.fakenotion`. Each benchmark reports the Notion requests
+by kind, the Studio requests, the wall time, and the peak memory. Run with:
+
+    python -m benchmarks.notion_benchmarks --sizes 100 1000 10000 --latency 0.005
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from libnotion import CollectionSnapshot
+from libregistry import ChannelRegistry
+from libsync import sync_channels_info, get_channel_card_values, STUDIO_WORKERS
+from benchmarks.fakenotion import FakeNotionClient
+
+
+BOARD_SIZES = [100, 1000, 10000]
+NOTION_LATENCY = 0.005     # seconds per simulated Notion request
+STUDIO_LATENCY = 0.005     # seconds per simulated Studio get_channel request
+CHANGED_FRACTION = 0.1     # fraction of the channels that changed in Studio since the last sync
+
+STUDIO_CHANNELS_SCHEMA = {
+    'title': {'name': 'Name', 'type': 'title'},
+    'name': {'name': 'name', 'type': 'text'},
+    'channel_id': {'name': 'channel_id', 'type': 'text'},
+    'description': {'name': 'description', 'type': 'text'},
+    'is_public': {'name': 'is_public', 'type': 'checkbox'},
+    'version': {'name': 'version', 'type': 'number'},
+    'channel_token': {'name': 'channel_token', 'type': 'text'},
+    'last_published': {'name': 'last_published', 'type': 'date'},
+    'has_stage_tree': {'name': 'has_stage_tree', 'type': 'checkbox'},
+    'edited': {'name': 'edited', 'type': 'last_edited_time'},
+}
+
+
+# FAKE STUDIO CHANNELS
+################################################################################
+
+class FakeStudioChannels(object):
+    """
+    Stand-in for the `get_channel` method of `StudioApi` that returns the
+    channel info dicts in `channels` after waiting `latency` seconds.
+    """
+
+    def __init__(self, channels, latency=STUDIO_LATENCY):
+        self.channels = channels
+        self.latency = latency
+        self.num_requests = 0
+        self._lock = threading.Lock()
+
+    def get_channel(self, channel_id):
+        with self._lock:
+            self.num_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.channels[channel_id]
+
+
+def make_channel_info(rng, index):
+    created = datetime(2019, 1, 1) + timedelta(minutes=rng.randint(0, 10**6))
+    return {
+        'id': '%032x' % rng.getrandbits(128),
+        'name': 'Channel {}'.format(index),
+        'description': 'Description of channel {}'.format(index),
+        'language': rng.choice(['en', 'es', 'fr', 'ar', 'sw']),
+        'public': rng.random() < 0.5,
+        'version': rng.randint(1, 50),
+        'primary_token': 'abcde-{:05d}'.format(index),
+        'created': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'staging_tree': None,
+    }
+
+
+def make_studio_channels_board(num_cards, changed_fraction=CHANGED_FRACTION, seed=42):
+    """
+    Returns `(client, view_url, studio_api)` for a synthetic "Studio Channels"
+    board with `num_cards` cards that are up to date with the Studio channel
+    info, except for `changed_fraction` of the channels that were republished.
+    """
+    rng = random.Random(seed)
+    client = FakeNotionClient()
+    view = client.create_collection(STUDIO_CHANNELS_SCHEMA, title='Studio Channels')
+    channels = {}
+    for index in range(num_cards):
+        channel_info = make_channel_info(rng, index)
+        card_values = get_channel_card_values(channel_info)
+        card_values['title'] = channel_info['name']
+        card_values['channel_id'] = channel_info['id']
+        view.collection.add_row(**card_values)
+        if rng.random() < changed_fraction:
+            channel_info['version'] += 1
+            channel_info['created'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        channels[channel_info['id']] = channel_info
+    client.clear_store()
+    client.reset_counts()
+    view_url = 'https://www.notion.so/fake/{}?v={}'.format(view.collection.id, view.id)
+    return client, view_url, FakeStudioChannels(channels)
+
+
+
+# BENCHMARKS
+################################################################################
+
+def measure(name, num_cards, client, studio_api, func):
+    client.reset_counts()
+    studio_requests_before = studio_api.num_requests
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'benchmark': name,
+        'cards': num_cards,
+        'notion_requests': client.num_requests(),
+        'notion_writes': client.counts['requests']['submitTransaction'],
+        'notion_requests_by_kind': dict(client.counts['requests']),
+        'studio_requests': studio_api.num_requests - studio_requests_before,
+        'seconds': round(elapsed, 3),
+        'peak_bytes': peak,
+        'result': result,
+    }
+
+
+def benchmark_board(num_cards, notion_latency=NOTION_LATENCY, studio_latency=STUDIO_LATENCY,
+                    changed_fraction=CHANGED_FRACTION, studio_workers=STUDIO_WORKERS):
+    """
+    Run the sync twice on a new board of `num_cards` cards (the first run
+    starts without a snapshot, the second finds nothing to update), then build
+    a channel registry from the cards. The `result` is the number of cards
+    updated by the sync, or the number of channels in the registry.
+    """
+    client, view_url, studio_api = make_studio_channels_board(num_cards, changed_fraction=changed_fraction)
+    client.latency = notion_latency
+    studio_api.latency = studio_latency
+    tmp_dir = tempfile.mkdtemp()
+    snapshot_path = os.path.join(tmp_dir, 'notion_channels_snapshot.json')
+
+    def _sync():
+        notion_channels = CollectionSnapshot(snapshot_path, view_url).refresh(client)
+        results, skipped = sync_channels_info(notion_channels, client, studio_api,
+                                              studio_workers=studio_workers)
+        return len([result for result in results if result['ok'] and result['result']])
+
+    def _update_registry():
+        notion_channels = CollectionSnapshot(snapshot_path, view_url).refresh(client)
+        registry = ChannelRegistry(path=':memory:')
+        registry.update_cards(notion_channels)
+        return registry.conn.execute('SELECT COUNT(*) FROM channels').fetchone()[0]
+
+    try:
+        return [
+            measure('sync (cold)', num_cards, client, studio_api, _sync),
+            measure('sync (no changes)', num_cards, client, studio_api, _sync),
+            measure('registry update', num_cards, client, studio_api, _update_registry),
+        ]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run_benchmarks(sizes=BOARD_SIZES, **kwargs):
+    results = []
+    for num_cards in sizes:
+        results.extend(benchmark_board(num_cards, **kwargs))
+    return results
+
+
+def format_results(results):
+    header = '{:<18} {:>6} {:>8} {:>7} {:>7} {:>9} {:>14} {:>7}'.format(
+        'benchmark', 'cards', 'notion', 'writes', 'studio', 'seconds', 'peak bytes', 'result')
+    lines = [header]
+    for result in results:
+        lines.append('{:<18} {:>6} {:>8} {:>7} {:>7} {:>9.3f} {:>14,} {:>7}'.format(
+            result['benchmark'], result['cards'], result['notion_requests'], result['notion_writes'],
+            result['studio_requests'], result['seconds'], result['peak_bytes'], result['result']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Studio Channels sync on fake Notion boards.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BOARD_SIZES, help='numbers of cards')
+    parser.add_argument('--latency', type=float, default=NOTION_LATENCY, help='Notion latency in seconds')
+    parser.add_argument('--studio-latency', type=float, default=STUDIO_LATENCY, help='Studio latency in seconds')
+    parser.add_argument('--changed', type=float, default=CHANGED_FRACTION, help='fraction of changed channels')
+    parser.add_argument('--json', help='also save the results to this json file')
+    args = parser.parse_args()
+    results = run_benchmarks(sizes=args.sizes, notion_latency=args.latency,
+                             studio_latency=args.studio_latency, changed_fraction=args.changed)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as jsonf:
+            json.dump(results, jsonf, indent=2)
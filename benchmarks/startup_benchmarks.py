@@ -0,0 +1,82 @@
+"""
+Measure how long `fab` takes to start (target: `fab -l` under one second) and
+which imports of the fabfile take the most time. Run with:
+
+    python -m benchmarks.startup_benchmarks --repeats 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+STARTUP_TARGET = 1.0     # seconds for `fab -l`
+STARTUP_REPEATS = 5
+TOP_IMPORTS = 15
+
+
+def time_command(cmd, repeats=STARTUP_REPEATS):
+    """
+    Run the command `cmd` (list of args) `repeats` times and return the list of
+    wall times in seconds. The first run is discarded to warm up the disk cache.
+    """
+    times = []
+    for i in range(repeats + 1):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        if i > 0:
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def get_import_times(module='fabfile', top=TOP_IMPORTS):
+    """
+    Import `module` in a new interpreter with `-X importtime` and return the
+    `top` slowest imports as a list of (cumulative seconds, module name) tuples.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    import_times = []
+    for line in result.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        import_times.append((int(cumulative_us) / 1e6, name.strip()))
+    import_times.sort(reverse=True)
+    return import_times[0:top]
+
+
+def run_benchmarks(repeats=STARTUP_REPEATS, top=TOP_IMPORTS):
+    """
+    Returns a dict with the `fab -l` and `import fabfile` times and the slowest imports.
+    """
+    fab_times = time_command(['fab', '-l'], repeats=repeats)
+    import_times = time_command([sys.executable, '-c', 'import fabfile'], repeats=repeats)
+    return {
+        'fab_list_seconds': statistics.median(fab_times),
+        'fab_list_min_seconds': min(fab_times),
+        'import_fabfile_seconds': statistics.median(import_times),
+        'slowest_imports': get_import_times(top=top),
+    }
+
+
+def format_results(results):
+    status = 'OK' if results['fab_list_seconds'] < STARTUP_TARGET else 'SLOW'
+    lines = [
+        'fab -l:          {:.3f}s median, {:.3f}s min ({} target {:.1f}s)'.format(
+            results['fab_list_seconds'], results['fab_list_min_seconds'], status, STARTUP_TARGET),
+        'import fabfile:  {:.3f}s median'.format(results['import_fabfile_seconds']),
+        'slowest imports (cumulative):',
+    ]
+    for seconds, name in results['slowest_imports']:
+        lines.append('  {:>8.3f}s  {}'.format(seconds, name))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark fab startup time.')
+    parser.add_argument('--repeats', type=int, default=STARTUP_REPEATS)
+    parser.add_argument('--top', type=int, default=TOP_IMPORTS, help='number of slowest imports to show')
+    args = parser.parse_args()
+    print(format_results(run_benchmarks(repeats=args.repeats, top=args.top)))
@@ -0,0 +1,183 @@
+"""
+Benchmarks for the Studio tree fetches and bulk edits in `libstudio`, run
+against the offline stand-in server in `benchmarks.fakestudio`. Each benchmark
+reports the number of HTTP requests, the wall time, and the peak memory used
+(measured with tracemalloc; the server runs in a separate process so it is not
+counted). Run with:
+
+    python -m benchmarks.studio_benchmarks --nodes 5000 --fanout 10 --latency 0.02
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import time
+import tracemalloc
+
+from libstudio import StudioApi, MutationBatcher
+from benchmarks.fakestudio import serve, DEFAULT_NUM_NODES, DEFAULT_FANOUT
+
+
+BENCHMARK_PORT = 8089
+BENCHMARK_LATENCY = 0.01    # seconds of simulated server latency per request
+BENCHMARK_NUM_EDITS = 200   # number of nodes edited/deleted in the bulk edit benchmarks
+
+
+# FAKE STUDIO SERVER PROCESS
+################################################################################
+
+@contextlib.contextmanager
+def fake_studio_server(num_nodes=DEFAULT_NUM_NODES, fanout=DEFAULT_FANOUT,
+                       latency=BENCHMARK_LATENCY, port=BENCHMARK_PORT):
+    """
+    Context manager that runs the fake Studio server in a subprocess and yields
+    `(studio_url, channel_id)` once it accepts requests.
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, kwargs=dict(num_nodes=num_nodes, fanout=fanout,
+                                                                latency=latency, port=port, ready=ready))
+    process.daemon = True
+    process.start()
+    try:
+        channel_id = ready.get(timeout=120)
+        yield 'http://127.0.0.1:{}'.format(port), channel_id
+    finally:
+        process.terminate()
+        process.join()
+
+
+def get_benchmark_api(studio_url):
+    """
+    Returns a StudioApi without response cache so every benchmark makes real requests.
+    """
+    return StudioApi('faketoken', username='bench', password='bench', studio_url=studio_url,
+                     cache_path=None, licenses_cache_path=None)
+
+
+def measure(name, studio_api, func):
+    """
+    Run `func()` and return a dict with the number of requests made by
+    `studio_api`, the wall time, and the peak memory allocated during the call.
+    """
+    requests_before = count_requests(studio_api)
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):   # silence per-request prints
+        result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'benchmark': name,
+        'requests': count_requests(studio_api) - requests_before,
+        'seconds': round(elapsed, 3),
+        'peak_bytes': peak,
+        'result': result,
+    }
+
+
+def count_requests(studio_api):
+    return sum(counters['requests'] for counters in studio_api.stats.as_dict().values())
+
+
+def count_tree_nodes(tree):
+    return 1 + sum(count_tree_nodes(child) for child in tree.get('children', []))
+
+
+
+# BENCHMARKS
+################################################################################
+
+def benchmark_tree_fetches(studio_url, channel_id):
+    """
+    Fetch the whole main tree depth-first, breadth-first, and streamed using `iter_tree`.
+    The `result` of each benchmark is the number of nodes fetched.
+    """
+    results = []
+    studio_api = get_benchmark_api(studio_url)
+    root_studio_id = studio_api.get_channel_root_studio_id(channel_id)
+    fetches = [
+        ('tree depth-first', lambda: count_tree_nodes(studio_api.get_tree_for_studio_id(root_studio_id))),
+        ('tree breadth-first', lambda: count_tree_nodes(
+            studio_api.get_tree_for_studio_id(root_studio_id, breadth_first=True))),
+        ('tree iter_tree', lambda: sum(1 for _ in studio_api.iter_tree(root_studio_id))),
+    ]
+    for name, func in fetches:
+        results.append(measure(name, studio_api, func))
+    return results
+
+
+def benchmark_bulk_edits(studio_url, channel_id, num_edits=BENCHMARK_NUM_EDITS):
+    """
+    Edit and delete `num_edits` leaf nodes one request at a time and batched
+    using `MutationBatcher`. Each benchmark uses a different set of nodes.
+    The `result` of each benchmark is the number of nodes modified.
+    """
+    studio_api = get_benchmark_api(studio_url)
+    leaves = [node for node, parent_id, depth in studio_api.iter_tree(
+        studio_api.get_channel_root_studio_id(channel_id)) if 'children' not in node]
+    for leaf in leaves:
+        leaf['tags'] = leaf['tags'] + ['benchmark']
+    assert len(leaves) >= 4 * num_edits, 'tree too small for {} edits'.format(num_edits)
+    groups = [leaves[i*num_edits:(i+1)*num_edits] for i in range(4)]
+    studio_api.get_trash_tree_id(channel_id)   # so the trash lookup is not counted
+
+    def _put_each(nodes):
+        return len([studio_api.put_contentnode(node) for node in nodes])
+
+    def _delete_each(nodes):
+        return len([studio_api.delete_contentnode(node, channel_id) for node in nodes])
+
+    def _batched(nodes, action):
+        batcher = MutationBatcher(studio_api)
+        for node in nodes:
+            if action == 'put':
+                batcher.put(node)
+            else:
+                batcher.delete(node, channel_id)
+        return len([result for result in batcher.flush() if result['ok']])
+
+    return [
+        measure('edit one-by-one', studio_api, lambda: _put_each(groups[0])),
+        measure('edit batched', studio_api, lambda: _batched(groups[1], 'put')),
+        measure('delete one-by-one', studio_api, lambda: _delete_each(groups[2])),
+        measure('delete batched', studio_api, lambda: _batched(groups[3], 'delete')),
+    ]
+
+
+def run_benchmarks(num_nodes=DEFAULT_NUM_NODES, fanout=DEFAULT_FANOUT, latency=BENCHMARK_LATENCY,
+                   num_edits=BENCHMARK_NUM_EDITS, port=BENCHMARK_PORT):
+    """
+    Start a fake Studio server and run all benchmarks. Returns a list of result dicts.
+    """
+    with fake_studio_server(num_nodes=num_nodes, fanout=fanout, latency=latency, port=port) as \
+            (studio_url, channel_id):
+        results = benchmark_tree_fetches(studio_url, channel_id)
+        results.extend(benchmark_bulk_edits(studio_url, channel_id, num_edits=num_edits))
+    return results
+
+
+def format_results(results):
+    lines = ['{:<20} {:>8} {:>10} {:>14} {:>8}'.format('benchmark', 'requests', 'seconds', 'peak bytes', 'result')]
+    for result in results:
+        lines.append('{:<20} {:>8} {:>10.3f} {:>14,} {:>8}'.format(
+            result['benchmark'], result['requests'], result['seconds'], result['peak_bytes'], result['result']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Studio tree fetches and bulk edits.')
+    parser.add_argument('--nodes', type=int, default=DEFAULT_NUM_NODES, help='number of nodes in the tree')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT, help='number of children of each topic')
+    parser.add_argument('--latency', type=float, default=BENCHMARK_LATENCY, help='server latency in seconds')
+    parser.add_argument('--edits', type=int, default=BENCHMARK_NUM_EDITS, help='number of nodes to edit')
+    parser.add_argument('--port', type=int, default=BENCHMARK_PORT)
+    parser.add_argument('--json', help='also save the results to this json file')
+    args = parser.parse_args()
+    results = run_benchmarks(num_nodes=args.nodes, fanout=args.fanout, latency=args.latency,
+                             num_edits=args.edits, port=args.port)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as jsonf:
+            json.dump(results, jsonf, indent=2)
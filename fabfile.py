@@ -1,6 +1,5 @@
+import atexit
 import datetime
-from dateutil.parser import parse
-from github import Github
 from io import BytesIO
 from itertools import groupby
 import json
@@ -12,16 +11,14 @@ import time
 
 from fabric.api import env, task, local, sudo, run, prompt
 from fabric.api import get, put, require
+from fabric.api import execute, parallel, settings
 from fabric.colors import red, green, blue, yellow
 from fabric.context_managers import cd, prefix, show, hide, shell_env, quiet, lcd
 from fabric.contrib.files import exists, sed, upload_template
 from fabric.utils import puts
 
-from libstudio import StudioApi
-
-from notion.client import NotionClient
-from libnotion import add_issue_tracker_to_card, get_github_to_notion_user_lookup_table
-from libnotion import get_channel_data_by_channel_id
+# The modules for the Studio, Notion, and Github integrations are imported in
+# the tasks that use them so that `fab -l` and the chef tasks start fast.
 
 
 # FAB SETTTINGS
@@ -36,6 +33,9 @@ STUDIO_TOKEN = os.environ.get('STUDIO_TOKEN')
 env.studio_user = os.environ.get('STUDIO_USER')
 env.studio_pass = os.environ.get('STUDIO_PASS')
 env.studio_url = os.environ.get('STUDIO_URL', 'https://studio.learningequality.org')
+STUDIO_CACHE_PATH = 'studio_cache.sqlite3'
+STUDIO_SNAPSHOTS_DIR = 'snapshots'
+STUDIO_STATS_PATH = os.environ.get('STUDIO_STATS_PATH')  # .json or .prom file for request stats
 
 env.roledefs = {
     'vader': {
@@ -61,8 +61,8 @@ from inventory import ( NICKNAME_KEY,
                         CRONTAB_KEY,
                         COMMENTS_KEY,
                         CHEFDIRNAME_KEY)
-from inventory import load_inventory
-INVENTORY = load_inventory()
+from inventory import LazyInventory
+INVENTORY = LazyInventory()   # the inventory sheet is loaded on first access
 
 
 # GLOBAL CHEF SETTINGS
@@ -73,6 +73,10 @@ CHEFS_DATA_DIR = '/data'
 CHEFS_LOGS_DIR = '/data/var/log'
 CHEFS_PID_DIR = '/data/var/run'
 CHEFS_CMDSOCKS_DIR = '/data/var/cmdsocks'
+CHEFS_WHEELHOUSE_DIR = '/data/var/wheelhouse'       # wheels shared by all chefs on the host
+CHEFS_VENV_TEMPLATES_DIR = '/data/var/venvs'        # one template venv per requirements hash
+CHEFVENV_PATH = '/data/var/chefvenv.sh'
+CHEFS_PYTHON = 'python3.5'
 
 
 
@@ -80,11 +84,16 @@ CHEFS_CMDSOCKS_DIR = '/data/var/cmdsocks'
 ################################################################################
 
 @task
-def run_chef(nickname, nohup=None, stage=False):
+def run_chef(nickname, nohup=None, stage=False, daemon=False):
+    """
+    Run chef `nickname`. Use `daemon=true` to start it in the background in
+    daemon mode, listening for commands on its control socket in CHEFS_CMDSOCKS_DIR.
+    """
     if STUDIO_TOKEN is None:
         raise ValueError('Must specify STUDIO_TOKEN env var on command line')
     nohup = (nohup == 'True' or nohup == 'true')  # defaults to False
     stage = (stage == 'True' or stage == 'true')  # defaults to False
+    daemon = (daemon == 'True' or daemon == 'true')  # defaults to False
 
     chef_info = INVENTORY[nickname]
     CHEF_DATA_DIR = os.path.join(CHEFS_DATA_DIR, chef_info[CHEFDIRNAME_KEY])
@@ -92,6 +101,8 @@ def run_chef(nickname, nohup=None, stage=False):
     cmd = chef_info[COMMAND_KEY].format(studio_token=STUDIO_TOKEN)
     if stage:
         cmd = add_args(cmd, {'--stage':None})
+    if daemon:
+        cmd = add_args(cmd, {'--daemon':None, '--cmdsock':get_chef_cmdsock(nickname)})
 
     if chef_cwd:
         chef_run_dir = os.path.join(CHEF_DATA_DIR, chef_cwd)
@@ -100,7 +111,14 @@ def run_chef(nickname, nohup=None, stage=False):
 
     with cd(chef_run_dir):
         with prefix('source ' + os.path.join(CHEF_DATA_DIR, 'venv/bin/activate')):
-            if nohup == False:
+            if daemon:
+                # Run in background, with pid file and log where chefctl.sh expects them
+                log_file = os.path.join(CHEFS_LOGS_DIR, nickname + '.log')
+                cmd_nohup = wrap_in_nohup(cmd, redirects='>>' + log_file + ' 2>&1',
+                                          pid_file=get_chef_daemon_pid_file(nickname))
+                sudo(cmd_nohup, user=CHEF_USER)
+                puts(green('Chef daemon started. Use `fab chef_command:' + nickname + '` to start a run.'))
+            elif nohup == False:
                 # Normal operation (blocking)
                 sudo(cmd, user=CHEF_USER)
             else:
@@ -129,17 +147,14 @@ def setup_chef(nickname, branch_name=DEFAULT_GIT_BRANCH):
         # checkout the desired branch
         with cd(CHEF_DATA_DIR):
             sudo('git checkout ' + branch_name, user=CHEF_USER)
-        # setup python virtualenv
-        with cd(CHEF_DATA_DIR):
-            sudo('virtualenv -p python3.5  venv', user=CHEF_USER)
+        # setup python virtualenv from the shared venv template for its requirements
+        upload_chefvenv_script()
+        sudo(CHEFVENV_PATH + ' ' + CHEF_DATA_DIR, user=CHEF_USER)
 
         with cd(CHEF_DATA_DIR):
             activate_sh = os.path.join(CHEF_DATA_DIR, 'venv/bin/activate')
-            reqs_filepath = os.path.join(CHEF_DATA_DIR, 'requirements.txt')
             # Nov 23: workaround____ necessary to avoid HOME env var being set wrong
             with prefix('export HOME=/data && source ' + activate_sh):
-                # install requirements
-                sudo('pip install --no-input --quiet -r ' + reqs_filepath, user=CHEF_USER)
                 # run post-setup command
                 if chef_info[POST_SETUP_COMMAND_KEY] is not None:
                     sudo(chef_info[POST_SETUP_COMMAND_KEY], user=CHEF_USER)
@@ -154,7 +169,12 @@ def unsetup_chef(nickname):
 
 
 @task
-def update_chef(nickname, branch_name=DEFAULT_GIT_BRANCH):
+def update_chef(nickname, branch_name=DEFAULT_GIT_BRANCH, refresh=False):
+    """
+    Pull the latest code of chef `nickname`. The venv is recreated only if the
+    requirements changed; use `refresh=true` to rebuild it with the latest packages.
+    """
+    refresh = (refresh == 'True' or refresh == 'true')  # defaults to False
     chef_info = INVENTORY[nickname]
     CHEF_DATA_DIR = os.path.join(CHEFS_DATA_DIR, chef_info[CHEFDIRNAME_KEY])
     
@@ -164,14 +184,277 @@ def update_chef(nickname, branch_name=DEFAULT_GIT_BRANCH):
         sudo('git reset --hard origin/' + branch_name, user=CHEF_USER)
 
     # update requirements
-    activate_sh = os.path.join(CHEF_DATA_DIR, 'venv/bin/activate')
-    reqs_filepath = os.path.join(CHEF_DATA_DIR, 'requirements.txt')
-    with prefix('export HOME=/data && source ' + activate_sh):
-        sudo('pip install -U --no-input --quiet -r ' + reqs_filepath, user=CHEF_USER)
+    upload_chefvenv_script()
+    cmd = CHEFVENV_PATH + ' ' + CHEF_DATA_DIR
+    if refresh:
+        cmd += ' --refresh'
+    sudo(cmd, user=CHEF_USER)
+
+
+def upload_chefvenv_script():
+    """
+    Upload the chefvenv.sh script that creates chef venvs from the shared
+    venv templates in CHEFS_VENV_TEMPLATES_DIR and wheels in CHEFS_WHEELHOUSE_DIR.
+    """
+    context = {
+        'data_dir': CHEFS_DATA_DIR,
+        'wheelhouse_dir': CHEFS_WHEELHOUSE_DIR,
+        'templates_dir': CHEFS_VENV_TEMPLATES_DIR,
+        'python': CHEFS_PYTHON,
+    }
+    upload_template('chefvenv.sh.j2', CHEFVENV_PATH, context=context, use_jinja=True,
+                    template_dir='templates', use_sudo=True, mode=0o755)
+    sudo('chown {}:{} {}'.format(CHEF_USER, CHEF_USER, CHEFVENV_PATH))
+
+
+@task
+def clear_venv_templates():
+    """
+    Remove the shared venv templates and wheelhouse (the chef venvs are not affected).
+    """
+    sudo('rm -rf {}/* {}/*'.format(CHEFS_VENV_TEMPLATES_DIR, CHEFS_WHEELHOUSE_DIR), user=CHEF_USER)
+    puts(green('Removed venv templates and wheels.'))
+
+
+SETUP_CHEFS_MAX_PARALLEL = 4      # max number of chefs set up at once by setup_chefs
+
+@task
+def setup_chefs(*nicknames, **kwargs):
+    """
+    Setup many chefs with a single generated script, e.g. `fab setup_chefs:chef1,chef2`
+    or `fab setup_chefs:all=true`, cloning and installing at most `max_parallel` at once.
+    """
+    setup_all = kwargs.get('all') in ['True', 'true']
+    branch_name = kwargs.get('branch_name', DEFAULT_GIT_BRANCH)
+    max_parallel = int(kwargs.get('max_parallel', SETUP_CHEFS_MAX_PARALLEL))
+    if setup_all:
+        nicknames = sorted(INVENTORY.keys())
+    if not nicknames:
+        raise ValueError('Specify the chef nicknames to setup or use all=true')
+    chefs = []
+    for nickname in nicknames:
+        chef_info = INVENTORY[nickname]
+        chefs.append({
+            'nickname': pipes.quote(nickname),
+            'repo_url': pipes.quote(chef_info[GITHUB_REPO_URL_KEY]),
+            'dirname': pipes.quote(chef_info[CHEFDIRNAME_KEY]),
+            'post_setup': chef_info[POST_SETUP_COMMAND_KEY],
+        })
+    context = {
+        'data_dir': CHEFS_DATA_DIR,
+        'logs_dir': CHEFS_LOGS_DIR,
+        'branch_name': pipes.quote(branch_name),
+        'max_parallel': max_parallel,
+        'chefvenv_path': CHEFVENV_PATH,
+        'chefs': chefs,
+    }
+    upload_chefvenv_script()
+    script_path = '/tmp/setup_chefs.sh'
+    upload_template('setup_chefs.sh.j2', script_path, context=context, use_jinja=True,
+                    template_dir='templates', mode=0o755)
+    puts(blue('Setting up {} chefs, {} at a time'.format(len(chefs), max_parallel)))
+    with settings(warn_only=True):
+        output = sudo('bash ' + script_path, user=CHEF_USER)
+    run('rm -f ' + script_path)
+
+    statuses = {}
+    for line in output.splitlines():
+        if line.startswith('STATUS\t'):
+            _, nickname, status, seconds = line.strip().split('\t')
+            statuses[nickname] = (status, int(seconds))
+    for nickname in nicknames:
+        status, seconds = statuses.get(nickname, ('unknown', 0))
+        log_file = os.path.join(CHEFS_LOGS_DIR, 'setup_' + nickname + '.log')
+        if status == 'ok':
+            puts(green('{}\tok\t{}s'.format(nickname, seconds)))
+        elif status == 'exists':
+            puts(yellow('{}\talready set up'.format(nickname)))
+        else:
+            puts(red('{}\t{}\tsee {}'.format(nickname, status, log_file)))
+    return statuses
+
+
+
+
+# CHEF SCHEDULER (cron jobs for the chefs with a Crontab Schedule in the inventory)
+################################################################################
+CHEFCTL_PATH = os.path.join(CHEFS_DATA_DIR, 'var/chefctl.sh')
+STUDIO_TOKEN_PATH = os.path.join(CHEFS_DATA_DIR, 'var/studio_token')
+SCHEDULE_MAX_CONCURRENT = 2          # max number of scheduled chefs running at once on a host
+SCHEDULE_QUEUE_TIMEOUT = 6*3600      # seconds a queued run waits for a free slot
+CRONTAB_BEGIN_MARKER = '# BEGIN cloud-chef schedule'
+CRONTAB_END_MARKER = '# END cloud-chef schedule'
+CRONTAB_SPECIAL_SCHEDULES = ['@yearly', '@annually', '@monthly', '@weekly', '@daily', '@midnight', '@hourly']
+
+def get_chef_pid_file(nickname):
+    return os.path.join(CHEFS_PID_DIR, nickname + '.pid')
+
+def get_chef_daemon_pid_file(nickname):
+    # not counted by chefctl.sh as a running chef since an idle daemon uses no slot
+    return os.path.join(CHEFS_PID_DIR, nickname + '.daemon.pid')
+
+def get_chef_cmdsock(nickname):
+    return os.path.join(CHEFS_CMDSOCKS_DIR, nickname + '.sock')
+
+def get_running_daemons():
+    """
+    Returns the nicknames of the chefs running in daemon mode on this host.
+    """
+    output = sudo('for pid_file in {}/*.daemon.pid; do '
+                  '[ -f "$pid_file" ] && kill -0 "$(cat "$pid_file")" 2>/dev/null && basename "$pid_file" .daemon.pid; '
+                  'done; true'.format(CHEFS_PID_DIR), user=CHEF_USER)
+    return output.split()
+
+
+def parse_crontab_schedule(schedule):
+    """
+    Returns the normalized crontab schedule string `schedule`, e.g. `0 3 * * *`
+    or `@daily`, or raises ValueError if it's not a valid schedule.
+    """
+    schedule = ' '.join(schedule.split())
+    if schedule in CRONTAB_SPECIAL_SCHEDULES:
+        return schedule
+    fields = schedule.split(' ')
+    if len(fields) != 5 or not all(re.match(r'^[\d\*/,\-A-Za-z]+$', field) for field in fields):
+        raise ValueError('Invalid crontab schedule ' + repr(schedule))
+    return schedule
+
+
+def get_scheduled_chefs():
+    """
+    Returns the list of (nickname, chef_info, schedule) for the chefs in the
+    inventory that have a valid Crontab Schedule.
+    """
+    scheduled_chefs = []
+    for nickname, chef_info in sorted(INVENTORY.items()):
+        if not chef_info[CRONTAB_KEY]:
+            continue
+        try:
+            schedule = parse_crontab_schedule(chef_info[CRONTAB_KEY])
+        except ValueError as e:
+            puts(yellow('Skipping chef ' + nickname + ': ' + str(e)))
+            continue
+        scheduled_chefs.append((nickname, chef_info, schedule))
+    return scheduled_chefs
+
+
+def replace_crontab_block(crontab, block_lines):
+    """
+    Replace the lines between CRONTAB_BEGIN_MARKER and CRONTAB_END_MARKER in the
+    text `crontab` with `block_lines`, keeping all other cron jobs.
+    """
+    lines, in_block = [], False
+    for line in crontab.splitlines():
+        if line.strip() == CRONTAB_BEGIN_MARKER:
+            in_block = True
+        elif line.strip() == CRONTAB_END_MARKER:
+            in_block = False
+        elif not in_block:
+            lines.append(line)
+    if block_lines:
+        lines.extend([CRONTAB_BEGIN_MARKER] + block_lines + [CRONTAB_END_MARKER])
+    return '\n'.join(lines) + '\n'
+
+
+def install_chef_crontab(block_lines):
+    with hide('running', 'stdout'):
+        crontab = sudo('crontab -l 2>/dev/null || true', user=CHEF_USER)
+    new_crontab = replace_crontab_block(crontab.replace('\r\n', '\n'), block_lines)
+    tmp_path = '/tmp/cloud-chef-crontab'
+    put(BytesIO(new_crontab.encode('utf-8')), tmp_path, mode=0o644)
+    sudo('crontab ' + tmp_path, user=CHEF_USER)
+    run('rm -f ' + tmp_path)
 
 
+@task
+def schedule_chefs(max_concurrent=SCHEDULE_MAX_CONCURRENT, on_busy='skip', queue_timeout=SCHEDULE_QUEUE_TIMEOUT):
+    """
+    Install cron jobs for the chefs set up on this host that have a Crontab Schedule
+    in the inventory. At most `max_concurrent` scheduled chefs run at once; runs
+    that would overlap a running chef or exceed the limit are skipped, or waited
+    for with `on_busy=queue`. Chefs running as daemons are not scheduled since
+    their runs can't be counted towards the limit (use `chef_command` to start
+    them). Run again after changing the inventory.
+    """
+    if STUDIO_TOKEN is None:
+        raise ValueError('Must specify STUDIO_TOKEN env var on command line')
+    if on_busy not in ['skip', 'queue']:
+        raise ValueError('on_busy must be skip or queue')
+    with hide('running', 'stdout'):
+        chefdirnames = sudo('ls -1 ' + CHEFS_DATA_DIR).split()
+        daemon_nicknames = get_running_daemons()
+    chefs, block_lines, schedules = [], [], {}
+    for nickname, chef_info, schedule in get_scheduled_chefs():
+        if chef_info[CHEFDIRNAME_KEY] not in chefdirnames:
+            puts(yellow('Skipping chef ' + nickname + ': not set up on this host.'))
+            continue
+        if nickname in daemon_nicknames:
+            puts(yellow('Skipping chef ' + nickname + ': running as a daemon, use chef_command to start it.'))
+            continue
+        CHEF_DATA_DIR = os.path.join(CHEFS_DATA_DIR, chef_info[CHEFDIRNAME_KEY])
+        chef_cwd = chef_info[WORKING_DIRECTORY_KEY]
+        chefs.append({
+            'nickname': nickname,
+            'run_dir': os.path.join(CHEF_DATA_DIR, chef_cwd) if chef_cwd else CHEF_DATA_DIR,
+            'activate_sh': os.path.join(CHEF_DATA_DIR, 'venv/bin/activate'),
+            'cmd': chef_info[COMMAND_KEY].format(studio_token='"$STUDIO_TOKEN"'),
+        })
+        block_lines.append(schedule + ' ' + CHEFCTL_PATH + ' ' + nickname)
+        schedules.setdefault(schedule, []).append(nickname)
+
+    # Upload the studio token and the chefctl.sh script used by the cron jobs
+    put(BytesIO(STUDIO_TOKEN.encode('utf-8')), STUDIO_TOKEN_PATH, use_sudo=True, mode=0o600)
+    context = {
+        'pid_dir': CHEFS_PID_DIR,
+        'logs_dir': CHEFS_LOGS_DIR,
+        'cmdsocks_dir': CHEFS_CMDSOCKS_DIR,
+        'token_path': STUDIO_TOKEN_PATH,
+        'home_dir': CHEFS_DATA_DIR,
+        'max_concurrent': int(max_concurrent),
+        'on_busy': on_busy,
+        'queue_timeout': int(queue_timeout),
+        'chefs': chefs,
+    }
+    upload_template('chefctl.sh.j2', CHEFCTL_PATH, context=context, use_jinja=True,
+                    template_dir='templates', use_sudo=True, mode=0o755)
+    sudo('chown {}:{} {} {}'.format(CHEF_USER, CHEF_USER, CHEFCTL_PATH, STUDIO_TOKEN_PATH))
+    install_chef_crontab(block_lines)
+
+    for schedule, nicknames in sorted(schedules.items()):
+        puts(green(schedule + '\t' + ', '.join(nicknames)))
+        if len(nicknames) > int(max_concurrent):
+            puts(yellow('  {} chefs share this schedule but only {} can run at once'.format(
+                len(nicknames), max_concurrent)))
+    puts(blue('Scheduled {} chefs.'.format(len(chefs))))
 
 
+@task
+def unschedule_chefs():
+    """
+    Remove the cron jobs installed by `schedule_chefs` (running chefs are not stopped).
+    """
+    install_chef_crontab([])
+    puts(green('Removed scheduled chefs from crontab.'))
+
+
+@task
+def scheduled_chefs_status():
+    """
+    Show which scheduled chefs are running or were started as daemons.
+    """
+    with hide('running'):
+        sudo(CHEFCTL_PATH + ' --status', user=CHEF_USER)
+
+
+@task
+def chef_command(nickname, command='start'):
+    """
+    Send `command` to the control socket of chef `nickname` running in daemon mode.
+    """
+    cmdsock = get_chef_cmdsock(nickname)
+    message = json.dumps({'command': command})
+    sudo("echo '{}' | nc -U -q 1 {}".format(message, cmdsock), user=CHEF_USER)
+
 
 
 # INFO
@@ -241,6 +524,178 @@ def pypsaux():
         print('\t'.join(output_vals))
 
 
+# FLEET (run tasks on all the hosts of a role and place chefs by load)
+################################################################################
+DEFAULT_FLEET_ROLE = 'cloud-kitchen'
+FLEET_POOL_SIZE = 8                     # max number of hosts a fleet task runs on at once
+MIN_DATA_FREE_KB = 10*1024*1024         # don't place chefs on hosts with less than 10GB free on /data
+PROBE_CMD = ('cat /proc/loadavg; nproc; '
+             'grep -E "^(MemTotal|MemAvailable):" /proc/meminfo; '
+             'df -Pk ' + CHEFS_DATA_DIR + ' | tail -1')
+
+class FleetTaskError(Exception):
+    pass
+
+
+def get_role_hosts(role):
+    roledef = env.roledefs[role]
+    return roledef['hosts'] if isinstance(roledef, dict) else roledef
+
+
+def _fleet_call(func, args, kwargs):
+    """
+    Call `func` on the current host and return a dict with the keys `host`,
+    `ok`, `result`, `error`, and `seconds`, instead of letting a failure on
+    one host abort the task on all the others.
+    """
+    start = time.time()
+    try:
+        with settings(abort_exception=FleetTaskError):
+            result = func(*args, **kwargs)
+        ok, error = True, None
+    except Exception as e:
+        result, ok, error = None, False, repr(e)
+    return {
+        'host': env.host_string,
+        'ok': ok,
+        'result': result,
+        'error': error,
+        'seconds': time.time() - start,
+    }
+
+
+def run_on_hosts(func, hosts, args=(), kwargs=None, pool_size=FLEET_POOL_SIZE):
+    """
+    Run `func(*args, **kwargs)` on all `hosts` in parallel, at most `pool_size`
+    hosts at a time. Returns the dict host --> result dict (see `_fleet_call`).
+    """
+    parallel_call = parallel(pool_size=pool_size)(_fleet_call)
+    return execute(parallel_call, func, args, kwargs or {}, hosts=hosts)
+
+
+def print_fleet_summary(results):
+    for host, host_result in sorted(results.items()):
+        if host_result['ok']:
+            puts(green('{}\tOK\t{:.1f}s'.format(host, host_result['seconds'])))
+        else:
+            puts(red('{}\tFAILED\t{:.1f}s\t{}'.format(host, host_result['seconds'], host_result['error'])))
+    num_failed = len([r for r in results.values() if not r['ok']])
+    puts(blue('{} hosts OK, {} failed'.format(len(results) - num_failed, num_failed)))
+
+
+@task
+def fleet(task_name, *args, **kwargs):
+    """
+    Run the task `task_name` on all hosts of a role in parallel, e.g.
+    `fab fleet:update_chef,mychef,role=cloud-kitchen,pool_size=4`.
+    """
+    role = kwargs.pop('role', DEFAULT_FLEET_ROLE)
+    pool_size = int(kwargs.pop('pool_size', FLEET_POOL_SIZE))
+    func = globals().get(task_name)
+    if func is None or task_name == 'fleet' or not hasattr(func, 'wrapped'):
+        raise ValueError('Unknown task ' + task_name)
+    hosts = get_role_hosts(role)
+    puts(blue('Running {} on {} hosts of role {}'.format(task_name, len(hosts), role)))
+    results = run_on_hosts(func, hosts, args=args, kwargs=kwargs, pool_size=pool_size)
+    print_fleet_summary(results)
+    return results
+
+
+def probe_host():
+    """
+    Collect the load average, number of CPUs, memory, and free space on /data
+    of the current host using a single remote command.
+    """
+    with hide('running', 'stdout'):
+        output = run(PROBE_CMD)
+    return parse_probe_output(output)
+
+
+def parse_probe_output(output):
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    meminfo = {}
+    for line in lines[2:4]:
+        key, value = line.split(':')
+        meminfo[key] = int(value.split()[0])
+    df_fields = lines[4].split()
+    return {
+        'load1': float(lines[0].split()[0]),
+        'cpus': int(lines[1]),
+        'mem_total_kb': meminfo['MemTotal'],
+        'mem_available_kb': meminfo['MemAvailable'],
+        'data_free_kb': int(df_fields[3]),
+        'data_total_kb': int(df_fields[1]),
+    }
+
+
+def get_headroom(probe):
+    """
+    Returns the headroom of a host as the smallest of its free fractions of CPU,
+    memory, and /data disk space, or 0 if /data has less than MIN_DATA_FREE_KB free.
+    """
+    if probe['data_free_kb'] < MIN_DATA_FREE_KB:
+        return 0.0
+    cpu_free = max(0.0, 1.0 - probe['load1'] / probe['cpus'])
+    mem_free = probe['mem_available_kb'] / probe['mem_total_kb']
+    disk_free = probe['data_free_kb'] / probe['data_total_kb']
+    return min(cpu_free, mem_free, disk_free)
+
+
+def probe_hosts(hosts, pool_size=FLEET_POOL_SIZE):
+    """
+    Probe all `hosts` in parallel. Returns the dict host --> result dict whose
+    `result` is the probe dict with the host's `headroom` added.
+    """
+    results = run_on_hosts(probe_host, hosts, pool_size=pool_size)
+    for host_result in results.values():
+        if host_result['ok']:
+            host_result['result']['headroom'] = get_headroom(host_result['result'])
+    return results
+
+
+@task
+def fleet_status(role=DEFAULT_FLEET_ROLE):
+    """
+    Print the load, free memory, free space on /data, and headroom of all hosts of `role`.
+    """
+    results = probe_hosts(get_role_hosts(role))
+    for host, host_result in sorted(results.items()):
+        if not host_result['ok']:
+            puts(red('{}\tunreachable\t{}'.format(host, host_result['error'])))
+            continue
+        probe = host_result['result']
+        print('\t'.join([host,
+                         'load={:.2f}/{}'.format(probe['load1'], probe['cpus']),
+                         'mem_free={:.1f}GB'.format(probe['mem_available_kb'] / 1024.0**2),
+                         'data_free={:.1f}GB'.format(probe['data_free_kb'] / 1024.0**2),
+                         'headroom={:.2f}'.format(probe['headroom'])]))
+
+
+@task
+def place_chef(nickname, role=DEFAULT_FLEET_ROLE, run_it=True):
+    """
+    Setup chef `nickname` on the host of `role` with the most headroom and run
+    it there in the background (use `run_it=false` to only set it up).
+    """
+    run_it = False if run_it == 'False' or run_it == 'false' else True
+    results = probe_hosts(get_role_hosts(role))
+    candidates = [(host_result['result']['headroom'], host) for host, host_result in results.items()
+                  if host_result['ok'] and host_result['result']['headroom'] > 0]
+    for host, host_result in sorted(results.items()):
+        if not host_result['ok']:
+            puts(yellow('Skipping unreachable host {}: {}'.format(host, host_result['error'])))
+    if not candidates:
+        puts(red('No host of role ' + role + ' has enough headroom for chef ' + nickname))
+        return None
+    headroom, best_host = max(candidates)
+    puts(blue('Placing chef {} on {} (headroom {:.2f})'.format(nickname, best_host, headroom)))
+    execute(setup_chef, nickname, hosts=[best_host])
+    if run_it:
+        execute(run_chef, nickname, nohup='true', hosts=[best_host])
+    return best_host
+
+
+
 # SYSADMIN TASKS (provision a new cloud chef host semi-automatically)
 ################################################################################
 
@@ -267,7 +722,7 @@ def install_base():
         sudo('apt-get install -y python3 python3-pip python3-dev python3-virtualenv virtualenv python3-tk')
         sudo('apt-get install -y linux-tools libfreetype6-dev libxft-dev libwebp-dev libjpeg-dev libmagickwand-dev')
         sudo('apt-get install -y ffmpeg psmisc pkg-config phantomjs')
-        sudo('apt-get install -y netcat-openbsd')  # for cronjobs to sending commands to chefs via control socket
+        sudo('apt-get install -y netcat-openbsd')  # for sending commands to chef daemons via control socket
         # TODO: Add chef user
 
     # 2. ADD SWAP
@@ -301,6 +756,10 @@ def install_base():
     # and /data/var/cmdsocks/ = command sockets used by cronjobs to `run` chefs
     if not exists(CHEFS_CMDSOCKS_DIR):
         sudo('mkdir -p ' + CHEFS_CMDSOCKS_DIR, user=CHEF_USER)
+    # /data/var/wheelhouse/ and /data/var/venvs/ = wheels and venv templates shared by all chefs
+    for shared_dir in [CHEFS_WHEELHOUSE_DIR, CHEFS_VENV_TEMPLATES_DIR]:
+        if not exists(shared_dir):
+            sudo('mkdir -p ' + shared_dir, user=CHEF_USER)
 
     puts(green('Base install steps finished.'))
 
@@ -317,6 +776,7 @@ def get_github_client(token=None):
     """
     Returns a token-authenticated github client (to avoid code duplication).
     """
+    from github import Github
     if token is None:
         with open(GITHUB_API_TOKEN_FILE, 'r') as tokenf:
             token = json.load(tokenf)[GITHUB_API_TOKEN_NAME]
@@ -459,83 +919,253 @@ def parse_psaux(psaux_str):
 
 @task
 def add_issue_tracker(id):
+    from libnotion import add_issue_tracker_to_card
     print('Adding "Issue Tracker" to notion card... https://www.notion.so/'+id)
     add_issue_tracker_to_card(id)
     puts(green('Issue Tracker added succesfully.'))
 
 
 @task
-def update_notion_channels_info():
+def add_issue_trackers(*card_ids, **kwargs):
+    """
+    Add "Issue Tracker" to many notion cards: pass the card ids as arguments,
+    or `collection_url=...` to add it to all the cards in a collection.
+    """
+    from libnotion import add_issue_trackers_to_cards, add_issue_trackers_to_collection
+    collection_url = kwargs.get('collection_url')
+    if collection_url:
+        results = add_issue_trackers_to_collection(collection_url)
+    else:
+        results = add_issue_trackers_to_cards(list(card_ids))
+    for card_id, result in results.items():
+        if result == 'created':
+            puts(green('Issue Tracker added to https://www.notion.so/' + card_id.replace('-', '')))
+        elif result != 'skipped':
+            puts(red('Failed to add Issue Tracker to card ' + card_id + ': ' + repr(result)))
+    num_created = len([result for result in results.values() if result == 'created'])
+    num_skipped = len([result for result in results.values() if result == 'skipped'])
+    puts(blue('{} Issue Trackers added, {} cards already had one.'.format(num_created, num_skipped)))
+
+
+def get_studio_api(cache_path=None):
+    """
+    Returns a StudioApi client using the credentials from the env. If the env
+    var STUDIO_STATS_PATH is set, the client's request stats are saved to that
+    file when the fab task finishes (Prometheus text format if it ends in .prom).
+    """
+    from libstudio import StudioApi
+    studio_api = StudioApi(studio_url=env.studio_url, token=STUDIO_TOKEN,
+                           username=env.studio_user, password=env.studio_pass,
+                           cache_path=cache_path)
+    if STUDIO_STATS_PATH:
+        atexit.register(save_studio_stats, studio_api, STUDIO_STATS_PATH)
+    return studio_api
+
+def save_studio_stats(studio_api, stats_path):
+    if stats_path.endswith('.prom'):
+        studio_api.stats.save_prometheus(stats_path)
+    else:
+        studio_api.stats.save_json(stats_path)
+    puts(blue('Saved Studio API request stats to ' + stats_path))
+
+
+@task
+def clear_studio_cache():
+    """
+    Remove all cached Studio API responses so the next sync refetches everything.
+    """
+    from libstudio import ResponseCache
+    ResponseCache(STUDIO_CACHE_PATH).clear()
+    puts(green('Cleared Studio API cache ' + STUDIO_CACHE_PATH))
+
+
+@task
+def export_channel_tree(channel_id, tree='main', jsonl_path=None):
+    """
+    Stream all the nodes of the `tree` tree of channel `channel_id` to a JSON
+    Lines file (one node per line, with `parent_id` and `depth` added).
+    """
+    studio_api = get_studio_api()
+    if jsonl_path is None:
+        jsonl_path = '{}_{}_tree.jsonl'.format(channel_id, tree)
+    root_studio_id = studio_api.get_channel_root_studio_id(channel_id, tree=tree)
+    num_nodes = 0
+    with open(jsonl_path, 'w', encoding='utf8') as jsonl_file:
+        for node, parent_id, depth in studio_api.iter_tree(root_studio_id):
+            node['parent_id'] = parent_id
+            node['depth'] = depth
+            jsonl_file.write(json.dumps(node, ensure_ascii=False) + '\n')
+            num_nodes += 1
+    puts(green('Exported {} nodes to {}'.format(num_nodes, jsonl_path)))
+
+
+def get_tree_snapshot(studio_api, root_studio_id, full=True):
+    """
+    Load the saved snapshot of the tree `root_studio_id`, refresh it, and save it.
+    Use `full=False` to refetch only the changed subtrees. Snapshots that contain
+    entries copied without being checked are not saved, so the saved snapshot is
+    always one where every node was fetched.
+    """
+    from libtrees import TreeSnapshot
+    if not os.path.exists(STUDIO_SNAPSHOTS_DIR):
+        os.makedirs(STUDIO_SNAPSHOTS_DIR)
+    snapshot_path = os.path.join(STUDIO_SNAPSHOTS_DIR, root_studio_id + '.json')
+    if os.path.exists(snapshot_path):
+        snapshot = TreeSnapshot.load(snapshot_path)
+    else:
+        snapshot = TreeSnapshot(root_studio_id)
+    snapshot = snapshot.refresh(studio_api, full=full)
+    if snapshot.num_copied == 0:
+        snapshot.save(snapshot_path)
+    return snapshot
+
+
+@task
+def diff_channel_trees(channel_id, old_tree='main', new_tree='staging', full=True):
+    """
+    Print the nodes added, removed, and modified between two trees of a channel.
+    All nodes are refetched by default; use `full=false` to refresh the saved
+    tree snapshots incrementally, which only detects changes to the structure
+    and metadata of subtrees and misses e.g. edits to the titles of leaf nodes.
+    """
+    from libtrees import diff_trees
+    full = not (full == 'False' or full == 'false' or full is False)  # defaults to True
+    if not full:
+        puts(yellow('Incremental diff: only changes to tree structure and metadata are detected. '
+                    'Omit full=false to compare all nodes.'))
+    studio_api = get_studio_api()
+    channel_data = studio_api.get_channel(channel_id)
+    if not channel_data.get(new_tree + '_tree'):
+        puts(yellow('Channel ' + channel_id + ' has no ' + new_tree + ' tree.'))
+        return
+    old_snapshot = get_tree_snapshot(studio_api, channel_data[old_tree + '_tree']['id'], full=full)
+    new_snapshot = get_tree_snapshot(studio_api, channel_data[new_tree + '_tree']['id'], full=full)
+    diff = diff_trees(old_snapshot, new_snapshot)
+    for change in ['added', 'removed', 'modified']:
+        puts(blue('{} {} nodes'.format(len(diff[change]), change)))
+        for node_id in diff[change]:
+            print('\t'.join([change, node_id]))
+
+
+@task
+def benchmark_tree_memory(channel_id, tree='main'):
+    """
+    Compare the memory used by a channel tree as nested dicts and as a CompactTree.
+    """
+    from libtrees import compare_tree_memory
+    studio_api = get_studio_api()
+    root_studio_id = studio_api.get_channel_root_studio_id(channel_id, tree=tree)
+    tree_dict = studio_api.get_tree_for_studio_id(root_studio_id, breadth_first=True)
+    results = compare_tree_memory(tree_dict)
+    puts(blue('Tree {} has {} nodes'.format(root_studio_id, results['num_nodes'])))
+    puts('  nested dicts: {:>12,} bytes'.format(results['dicts_bytes']))
+    puts('  CompactTree:  {:>12,} bytes'.format(results['compact_bytes']))
+
+
+@task
+def benchmark_studio(nodes=1000, fanout=10, latency=0.01, edits=200):
+    """
+    Benchmark tree fetches and bulk edits against an offline fake Studio server.
+    """
+    from benchmarks.studio_benchmarks import run_benchmarks, format_results
+    results = run_benchmarks(num_nodes=int(nodes), fanout=int(fanout),
+                             latency=float(latency), num_edits=int(edits))
+    puts(format_results(results))
+
+
+@task
+def benchmark_notion_sync(*sizes, **kwargs):
+    """
+    Benchmark the Studio Channels sync on fake Notion boards, e.g. `fab benchmark_notion_sync:100,1000,10000`.
+    """
+    from benchmarks.notion_benchmarks import run_benchmarks, format_results, BOARD_SIZES
+    sizes = [int(size) for size in sizes] or BOARD_SIZES
+    options = {}
+    if 'latency' in kwargs:
+        options['notion_latency'] = float(kwargs['latency'])
+    if 'studio_latency' in kwargs:
+        options['studio_latency'] = float(kwargs['studio_latency'])
+    results = run_benchmarks(sizes=sizes, **options)
+    puts(format_results(results))
+
+
+@task
+def benchmark_startup(repeats=5):
+    """
+    Time `fab -l` and `import fabfile`, and list the slowest imports of the fabfile.
+    """
+    from benchmarks.startup_benchmarks import run_benchmarks, format_results
+    puts(format_results(run_benchmarks(repeats=int(repeats))))
+
+
+@task
+def update_notion_channels_info(studio_workers=None):
     """
     Update the "Studio Channels" notion board cards with latest info from Studio.
     """
+    from notion.client import NotionClient
+    from libnotion import get_studio_channels_snapshot
+    from libsync import sync_channels_info, STUDIO_WORKERS
+    studio_workers = int(studio_workers) if studio_workers else STUDIO_WORKERS
+
     # Studio API client
-    if os.path.exists('cache.sqlite3'):
-        os.remove('cache.sqlite3')
-    studio_api = StudioApi(studio_url=env.studio_url, token=STUDIO_TOKEN,
-                           username=env.studio_user, password=env.studio_pass)
+    studio_api = get_studio_api(cache_path=STUDIO_CACHE_PATH)
 
     # Notion API
     client = NotionClient(token_v2=env.notion_token, monitor=False)
-    studio_channels_url = 'https://www.notion.so/learningequality/761249f8782c48289780d6693431d900?v=44827975ce5f4b23b5157381fac302c4'
-    page = client.get_block(studio_channels_url)
-    notion_channels = page.collection.get_rows()
-
-    # Update Notion channels using info from Studio API
-    for notion_channel in notion_channels:
-        channel_id = notion_channel.get_property('channel_id')
-        if '[' in channel_id and ']' in channel_id:
-            channel_id = channel_id.split('[')[1].split(']')[0]
-        channel_name = notion_channel.get_property('name')
-        if channel_id:
-            puts(green('Updating notion card for channel ' + channel_name + ' channel_id=' + channel_id))
-            # get info from Studio API
-            channel_info_dict = studio_api.get_channel(channel_id)
-            notion_channel.is_public = channel_info_dict['public']
-            notion_channel.description = channel_info_dict['description']
-            notion_channel.version = channel_info_dict['version']
-            notion_channel.name = channel_info_dict['name']
-            notion_channel.channel_token = channel_info_dict['primary_token']
-            created_date = parse(channel_info_dict['created'])
-            notion_channel.last_published = created_date
-            if channel_info_dict.get('staging_tree', None):
-                notion_channel.has_stage_tree = True
-
+    notion_channels = get_studio_channels_snapshot(client=client).get_rows(client)
+
+    # Update Notion channels using info from Studio API: a pool of Studio
+    # fetchers runs concurrently with a single Notion writer
+    results, skipped = sync_channels_info(notion_channels, client, studio_api,
+                                          studio_workers=studio_workers)
+    for channel_name in skipped:
+        puts(yellow('Skipping channel named ' + channel_name))
+    for result in results:
+        _, channel_id, channel_name = result['item']
+        if not result['ok']:
+            puts(red('Failed to ' + result['stage'] + ' channel ' + channel_name + ' channel_id=' + channel_id + ': ' + repr(result['error'])))
+        elif result['result']:
+            puts(green('Updated ' + ', '.join(sorted(result['result'].keys())) + ' for channel ' + channel_name + ' channel_id=' + channel_id))
         else:
-            puts(yellow('Skipping channel named ' + channel_name))
+            puts('No changes for channel ' + channel_name + ' channel_id=' + channel_id)
 
 
+CHANNELS_INFO_FIELDNAMES = ['channel_id', 'version', 'language', 'name', 'token', 'public',
+                            'created', 'source_id', 'published_size']
 
 @task
-def export_channels_info(keyword=''):
+def export_channels_info(keyword='', restart=False):
     """
     Export the complete list of channel info from Notion API and Studio API.
     Only channels that contain keyword in their name will be exported.
+    Records are written to channels_info.partial.{jsonl,csv} as they are
+    produced; rerun with the same keyword to resume an interrupted export
+    (a different keyword starts a new export) or use `restart=true`.
     """
-    # Studio API client
-    if os.path.exists('cache.sqlite3'):
-        os.remove('cache.sqlite3')
-    studio_api = StudioApi(studio_url=env.studio_url, token=STUDIO_TOKEN,
-                           username=env.studio_user, password=env.studio_pass)
-    # Notion API
-    client = NotionClient(token_v2=env.notion_token, monitor=False)
-    studio_channels_url = 'https://www.notion.so/learningequality/761249f8782c48289780d6693431d900?v=44827975ce5f4b23b5157381fac302c4'
-    page = client.get_block(studio_channels_url)
-    notion_channels = page.collection.get_rows()
-    #
-    export_data = []
-    for notion_channel in notion_channels:
-        channel_id = notion_channel.get_property('channel_id')
-        
-        if '[' in channel_id and ']' in channel_id:
-            channel_id = channel_id.split('[')[1].split(']')[0]
-        if len(channel_id) != 32:
-            continue  # skip cards that don't have a valid-looking channel_id
-        channel_name = notion_channel.get_property('name')
-        if channel_id and keyword in channel_name:
+    from libexport import StreamingExporter
+    restart = (restart == 'True' or restart == 'true')  # defaults to False
+    registry = get_channel_registry()
+    with StreamingExporter('channels_info', CHANNELS_INFO_FIELDNAMES, 'channel_id',
+                           params={'keyword': keyword}) as exporter:
+        if restart:
+            exporter.reset()
+            exporter.open()
+        # refresh Studio info only for the matching channels not yet exported that are stale
+        channel_ids = [channel['channel_id'] for channel in registry.search(name_contains=keyword)
+                       if not exporter.is_done(channel['channel_id'])]
+        studio_api = get_studio_api(cache_path=STUDIO_CACHE_PATH)
+        errors = registry.refresh_stale(studio_api, channel_ids=channel_ids)
+        for channel in registry.search(name_contains=keyword):
+            channel_id, channel_name = channel['channel_id'], channel['card_name']
+            channel_info_dict = channel['studio_data']
+            if exporter.is_done(channel_id):
+                continue
+            if channel_info_dict is None:
+                error = errors.get(channel_id, 'no Studio info')
+                puts(red('Failed to get info for channel ' + channel_name + ' channel_id=' + channel_id + ': ' + repr(error)))
+                continue
             puts(green('Exporting infor for channel ' + channel_name + ' channel_id=' + channel_id))
-            # get info from Studio API
-            channel_info_dict = studio_api.get_channel(channel_id)
             datum = {}
             datum['channel_id'] = channel_info_dict['id']
             datum['version'] = channel_info_dict['version']
@@ -546,8 +1176,36 @@ def export_channels_info(keyword=''):
             datum['created'] = channel_info_dict['created']
             datum['source_id'] = channel_info_dict['source_id']
             datum['published_size'] = channel_info_dict['published_size']
-            export_data.append(datum)
-    with open('channels_info.json', 'w', encoding='utf8') as json_file:
-        json.dump(export_data, json_file, indent=2, ensure_ascii=False)
+            exporter.write(datum)
+        num_exported = exporter.finalize()
+    puts(blue('Exported {} channels to {} and {}'.format(num_exported, exporter.json_path, exporter.csv_path)))
 
 
+@task
+def find_channels(text=None, language=None, public=None):
+    """
+    Search the local channel registry, e.g. `fab find_channels:text=math,language=en,public=true`.
+    """
+    if public is not None:
+        public = (public == 'True' or public == 'true')
+    registry = get_channel_registry()
+    channels = registry.search(text=text, language=language, public=public)
+    studio_api = get_studio_api(cache_path=STUDIO_CACHE_PATH)
+    registry.refresh_stale(studio_api, channel_ids=[channel['channel_id'] for channel in channels])
+    for channel in registry.search(text=text, language=language, public=public):
+        print('\t'.join([channel['channel_id'], str(channel['language']),
+                         'public' if channel['public'] else 'private', str(channel['name'])]))
+
+
+def get_channel_registry():
+    """
+    Returns the local channel registry updated with the latest Notion cards.
+    """
+    from notion.client import NotionClient
+    from libnotion import get_studio_channels_snapshot
+    from libregistry import ChannelRegistry
+    client = NotionClient(token_v2=env.notion_token, monitor=False)
+    notion_channels = get_studio_channels_snapshot(client=client).get_rows(client)
+    registry = ChannelRegistry()
+    registry.update_cards(notion_channels)
+    return registry
@@ -1,6 +1,11 @@
 import csv
+import hashlib
+import io
+import json
+import logging as LOGGER
+import os
 import re
-import requests
+import time
 
 
 
@@ -11,6 +16,10 @@ INVENTORY_SHEET_ID = '1vx07agIPaboRHthtGGjJqiLQbXzzM1Mr5gUxxnrexq0'
 INVENTORY_SHEET_GID = '0'
 INVENTORY_SHEET_URL = GSHEETS_BASE + INVENTORY_SHEET_ID + '/export?format=csv&gid=' + INVENTORY_SHEET_GID
 INVENTORY_CSV_PATH = 'inventory/chef_inventory.csv'
+INVENTORY_META_PATH = 'inventory/chef_inventory.meta.json'   # ETag, Last-Modified, and fetch time
+INVENTORY_INDEX_PATH = 'inventory/chef_inventory.index.json' # parsed inventory keyed by CSV content hash
+INVENTORY_MAX_AGE = 3600   # seconds before the cached CSV is revalidated with the Google Sheet
+INVENTORY_TIMEOUT = 10     # seconds
 
 # CSV header keys
 NICKNAME_KEY = 'Nickname'
@@ -39,12 +48,55 @@ CHEFDIRNAME_KEY = 'chefdirname'
 
 
 
-def download_inventory_csv():
-    response = requests.get(INVENTORY_SHEET_URL)
-    csv_data = response.content.decode('utf-8')
-    with open(INVENTORY_CSV_PATH, 'w') as csvfile:
-        csvfile.write(csv_data)
+def _load_inventory_meta():
+    if os.path.exists(INVENTORY_META_PATH):
+        with open(INVENTORY_META_PATH, 'r') as metaf:
+            return json.load(metaf)
+    return {}
+
+def _save_inventory_meta(meta):
+    with open(INVENTORY_META_PATH, 'w') as metaf:
+        json.dump(meta, metaf, indent=2)
+
+
+def download_inventory_csv(max_age=INVENTORY_MAX_AGE, force=False):
+    """
+    Make sure INVENTORY_CSV_PATH contains a recent copy of the inventory sheet.
+    The cached CSV is used as is if it was fetched less than `max_age` seconds
+    ago, otherwise it is revalidated using a conditional GET (ETag and
+    Last-Modified) so an unchanged sheet is not downloaded again. If the sheet
+    cannot be fetched, the stale cached CSV is used when available.
+    """
+    import requests   # imported here since most fab tasks don't need to download
+    meta = _load_inventory_meta()
+    have_cached = os.path.exists(INVENTORY_CSV_PATH)
+    if have_cached and not force and time.time() - meta.get('fetched_at', 0) < max_age:
+        return
+    headers = {}
+    if have_cached and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if have_cached and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        response = requests.get(INVENTORY_SHEET_URL, headers=headers, timeout=INVENTORY_TIMEOUT)
+        if response.status_code != 304:
+            response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        if not have_cached:
+            raise
+        LOGGER.warning('Could not download inventory, using cached ' + INVENTORY_CSV_PATH + ': ' + repr(e))
+        return
+    if response.status_code == 200:
+        csv_data = response.content.decode('utf-8')
+        tmp_path = INVENTORY_CSV_PATH + '.tmp'
+        with open(tmp_path, 'w') as csvfile:
+            csvfile.write(csv_data)
+        os.replace(tmp_path, INVENTORY_CSV_PATH)
         # print('Succesfully saved ' + INVENTORY_CSV_PATH)
+        meta['etag'] = response.headers.get('ETag')
+        meta['last_modified'] = response.headers.get('Last-Modified')
+    meta['fetched_at'] = time.time()
+    _save_inventory_meta(meta)
 
 def _clean_dict(row):
     """
@@ -59,24 +111,119 @@ def _clean_dict(row):
     return row_cleaned
 
 
-def load_inventory():
-    download_inventory_csv()
+_parsed_inventory = {'sha1': None, 'inventory': None}   # last parsed CSV content hash and result
+
+
+def parse_inventory_csv(csv_data):
+    """
+    Parse the CSV export of the inventory sheet into a dict nickname --> chef info.
+    """
     chefs_inventory = {}
+    reader = csv.DictReader(io.StringIO(csv_data), fieldnames=INVENTORY_FIELDNAMES)
+    next(reader)  # Skip Headers row
+    next(reader)  # Skip description row
+    for row in reader:
+        clean_row = _clean_dict(row)
+        nickname = clean_row[NICKNAME_KEY]
+        if not nickname:
+            # print('Skipping inventory row', clean_row)
+            continue
+        dirname = github_repo_to_chefdir(clean_row[GITHUB_REPO_URL_KEY])
+        clean_row[CHEFDIRNAME_KEY] = dirname
+        chefs_inventory[nickname] = clean_row
+    return chefs_inventory
+
+
+def _load_inventory_index(sha1):
+    """
+    Returns the inventory saved in INVENTORY_INDEX_PATH if it was parsed from
+    a CSV with content hash `sha1`, otherwise None.
+    """
+    if not os.path.exists(INVENTORY_INDEX_PATH):
+        return None
+    with open(INVENTORY_INDEX_PATH, 'r') as indexf:
+        index = json.load(indexf)
+    if index.get('sha1') != sha1:
+        return None
+    fieldnames = index['fieldnames']
+    return dict((row[0], dict(zip(fieldnames, row[1:]))) for row in index['rows'])
+
+def _save_inventory_index(sha1, chefs_inventory):
+    """
+    Save the parsed inventory as a compact list of rows (the nickname followed
+    by the values of the fields) under the CSV content hash `sha1`.
+    """
+    fieldnames = INVENTORY_FIELDNAMES + [CHEFDIRNAME_KEY]
+    index = {
+        'sha1': sha1,
+        'fieldnames': fieldnames,
+        'rows': [[nickname] + [chef_info.get(key) for key in fieldnames]
+                 for nickname, chef_info in chefs_inventory.items()],
+    }
+    tmp_path = INVENTORY_INDEX_PATH + '.tmp'
+    with open(tmp_path, 'w') as indexf:
+        json.dump(index, indexf, separators=(',', ':'))
+    os.replace(tmp_path, INVENTORY_INDEX_PATH)
+
+
+def load_inventory(max_age=INVENTORY_MAX_AGE):
+    """
+    Returns the chef inventory, downloading the sheet only when the cached CSV
+    is older than `max_age` seconds. The CSV is only parsed again if its
+    content changed since it was last parsed, otherwise the inventory is
+    loaded from the index saved in INVENTORY_INDEX_PATH.
+    """
+    download_inventory_csv(max_age=max_age)
     with open(INVENTORY_CSV_PATH, 'r') as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=INVENTORY_FIELDNAMES)
-        next(reader)  # Skip Headers row
-        next(reader)  # Skip description row
-        for row in reader:
-            clean_row = _clean_dict(row)
-            nickname = clean_row[NICKNAME_KEY]
-            if not nickname:
-                # print('Skipping inventory row', clean_row)
-                continue
-            dirname = github_repo_to_chefdir(clean_row[GITHUB_REPO_URL_KEY])
-            clean_row[CHEFDIRNAME_KEY] = dirname
-            chefs_inventory[nickname] = clean_row
+        csv_data = csvfile.read()
+    sha1 = hashlib.sha1(csv_data.encode('utf-8')).hexdigest()
+    if _parsed_inventory['sha1'] != sha1:
+        chefs_inventory = _load_inventory_index(sha1)
+        if chefs_inventory is None:
+            chefs_inventory = parse_inventory_csv(csv_data)
+            _save_inventory_index(sha1, chefs_inventory)
+        _parsed_inventory['inventory'] = chefs_inventory
+        _parsed_inventory['sha1'] = sha1
+    return _parsed_inventory['inventory']
 
-    return chefs_inventory
+
+class LazyInventory(object):
+    """
+    Dict-like view of the chef inventory that calls `load_inventory` on first
+    access, so importing the fabfile doesn't download the inventory sheet.
+    """
+
+    def __init__(self):
+        self._inventory = None
+
+    def _load(self):
+        if self._inventory is None:
+            self._inventory = load_inventory()
+        return self._inventory
+
+    def __getitem__(self, nickname):
+        return self._load()[nickname]
+
+    def __contains__(self, nickname):
+        return nickname in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def get(self, nickname, default=None):
+        return self._load().get(nickname, default)
+
+    def keys(self):
+        return self._load().keys()
+
+    def values(self):
+        return self._load().values()
+
+    def items(self):
+        return self._load().items()
 
 
 
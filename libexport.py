@@ -0,0 +1,150 @@
+import csv
+import json
+import logging as LOGGER
+import os
+
+
+# STREAMING EXPORT
+################################################################################
+PARAMS_PREFIX = '#params '   # first line of the checkpoint file
+
+class StreamingExporter(object):
+    """
+    Writes export records one at a time to `{basename}.partial.jsonl` and
+    `{basename}.partial.csv` as they are produced, and keeps a checkpoint file
+    with the keys (values of `key_field`) of the records written, so that an
+    interrupted export can be rerun and skip the records already done.
+    The checkpoint also stores `params` (a json-serializable dict of the export
+    options), and the partial files are discarded if they were written with
+    different params, so a resumed export never mixes two different exports.
+    Call `finalize` at the end to produce `{basename}.json` (a JSON array, same
+    as the non-streaming export) and `{basename}.csv`, and remove the partial files.
+    Usage:
+        with StreamingExporter('channels_info', fieldnames, 'channel_id', params={'keyword': keyword}) as exporter:
+            for record in records:
+                if not exporter.is_done(record['channel_id']):
+                    exporter.write(record)
+            exporter.finalize()
+    """
+
+    def __init__(self, basename, fieldnames, key_field, params=None):
+        self.basename = basename
+        self.fieldnames = fieldnames
+        self.key_field = key_field
+        self.params = params or {}
+        self.jsonl_path = basename + '.partial.jsonl'
+        self.partial_csv_path = basename + '.partial.csv'
+        self.checkpoint_path = basename + '.checkpoint'
+        self.json_path = basename + '.json'
+        self.csv_path = basename + '.csv'
+        self.done_keys = set()
+        self.jsonl_file = None
+        self.csv_file = None
+        self.checkpoint_file = None
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as checkpointf:
+                first_line = checkpointf.readline()
+                self.done_keys = set(line.strip() for line in checkpointf if line.strip())
+            if not first_line.startswith(PARAMS_PREFIX) or \
+                    json.loads(first_line[len(PARAMS_PREFIX):]) != self.params:
+                LOGGER.warning('Discarding partial export ' + self.jsonl_path + ' made with different options')
+                self.reset()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        csv_is_new = not os.path.exists(self.partial_csv_path) or os.path.getsize(self.partial_csv_path) == 0
+        self.jsonl_file = open(self.jsonl_path, 'a', encoding='utf8')
+        self.csv_file = open(self.partial_csv_path, 'a', encoding='utf8', newline='')
+        self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=self.fieldnames, extrasaction='ignore')
+        if csv_is_new:
+            self.csv_writer.writeheader()
+        checkpoint_is_new = not os.path.exists(self.checkpoint_path) or os.path.getsize(self.checkpoint_path) == 0
+        self.checkpoint_file = open(self.checkpoint_path, 'a')
+        if checkpoint_is_new:
+            self.checkpoint_file.write(PARAMS_PREFIX + json.dumps(self.params, sort_keys=True) + '\n')
+            self.checkpoint_file.flush()
+
+    def close(self):
+        for f in [self.jsonl_file, self.csv_file, self.checkpoint_file]:
+            if f is not None and not f.closed:
+                f.close()
+
+    def reset(self):
+        """
+        Forget about the records from previous runs and start a new export.
+        """
+        self.close()
+        for path in [self.jsonl_path, self.partial_csv_path, self.checkpoint_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.done_keys = set()
+
+    def is_done(self, key):
+        return key in self.done_keys
+
+    def write(self, record):
+        """
+        Append `record` to the partial files and mark its key as done. The record
+        is flushed before the checkpoint so a key is never marked done without
+        its record (a crash in between can only cause a duplicate record, which
+        is removed in `finalize`).
+        """
+        self.jsonl_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.jsonl_file.flush()
+        self.csv_writer.writerow(record)
+        self.csv_file.flush()
+        key = record[self.key_field]
+        self.checkpoint_file.write(key + '\n')
+        self.checkpoint_file.flush()
+        self.done_keys.add(key)
+
+    def _iter_final_records(self):
+        """
+        Yield the records in the partial jsonl file, keeping the last record
+        written for each key at the position of the first one. Only the file
+        offset of each key's record is held in memory.
+        """
+        offsets_by_key = {}   # dicts keep first-insertion order
+        with open(self.jsonl_path, 'rb') as jsonlf:
+            offset = 0
+            for line in jsonlf:
+                if line.strip():
+                    offsets_by_key[json.loads(line.decode('utf8'))[self.key_field]] = offset
+                offset += len(line)
+            for offset in offsets_by_key.values():
+                jsonlf.seek(offset)
+                yield json.loads(jsonlf.readline().decode('utf8'))
+
+    def finalize(self):
+        """
+        Atomically write the final JSON array and CSV files from the partial
+        jsonl file (keeping the last record for each key), streaming the records
+        one at a time, then remove the partial files and the checkpoint.
+        Returns the number of records exported.
+        """
+        self.close()
+        num_records = 0
+        tmp_json_path = self.json_path + '.tmp'
+        tmp_csv_path = self.csv_path + '.tmp'
+        with open(tmp_json_path, 'w', encoding='utf8') as json_file, \
+                open(tmp_csv_path, 'w', encoding='utf8', newline='') as csv_file:
+            csv_writer = csv.DictWriter(csv_file, fieldnames=self.fieldnames, extrasaction='ignore')
+            csv_writer.writeheader()
+            json_file.write('[')
+            for record in self._iter_final_records():
+                # same layout as json.dump(records, indent=2)
+                json_file.write(',\n  ' if num_records else '\n  ')
+                json_file.write(json.dumps(record, indent=2, ensure_ascii=False).replace('\n', '\n  '))
+                csv_writer.writerow(record)
+                num_records += 1
+            json_file.write('\n]' if num_records else ']')
+        os.replace(tmp_json_path, self.json_path)
+        os.replace(tmp_csv_path, self.csv_path)
+        self.reset()
+        return num_records
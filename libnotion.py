@@ -1,11 +1,15 @@
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import date, datetime
+import json
 import logging as LOGGER
 import os
 from pprint import pprint
+import threading
+import time
 
 from notion.block import CollectionViewBlock
 from notion.client import NotionClient
-from notion.collection import CollectionRowBlock
+from notion.collection import CollectionRowBlock, NotionDate
 
 
 
@@ -37,17 +41,89 @@ def get_notion_client(token_v2=None, **kwargs):
 
 
 
+# CARD UPDATES
+################################################################################
+def normalize_property_value(value):
+    """
+    Normalize the value of a notion property so values read from a card can be
+    compared with new values. Dates are compared to the minute since that is
+    the precision notion stores, and empty values compare equal to ''.
+    """
+    if isinstance(value, NotionDate):
+        value = value.start
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    return value
+
+
+def get_changed_properties(card, new_values):
+    """
+    Returns the subset of the dict `new_values` (property name --> value) that
+    differ from the current values of the properties of `card`.
+    """
+    changed = {}
+    for name, new_value in new_values.items():
+        current_value = card.get_property(name)
+        if normalize_property_value(current_value) != normalize_property_value(new_value):
+            changed[name] = new_value
+    return changed
+
+
+TRANSACTION_LOCK = threading.Lock()
+
+@contextmanager
+def atomic_transaction(client):
+    """
+    Group all the writes made inside the context into a single transaction,
+    for versions of notion-py that support it. The pending operations of a
+    transaction are stored on the client, so only one thread at a time can
+    have a transaction open.
+    """
+    if hasattr(client, 'as_atomic_transaction'):
+        with TRANSACTION_LOCK, client.as_atomic_transaction():
+            yield
+    else:
+        yield
+
+
+def update_card_properties(card, new_values, client=None):
+    """
+    Set the properties of `card` to the values in the dict `new_values`, only
+    writing the properties whose value changed, in a single transaction.
+    Returns the dict of properties that were changed.
+    """
+    changed = get_changed_properties(card, new_values)
+    if changed:
+        if client is None:
+            client = card._client
+        with atomic_transaction(client):
+            for name, value in changed.items():
+                card.set_property(name, value)
+    return changed
+
+
+
 # ISSUE TRACKER
 ################################################################################
 ISSUE_TRACKER_TEMPLATE_CVB_ID = 'd383ec64-1d92-4ab9-b577-18844859f5ad'
+ISSUE_TRACKER_TITLE = 'Issue Tracker'
+REFRESH_RECORDS_CHUNK_SIZE = 100
 
-def get_by_type_and_title(page, type_, title):
+def find_by_type_and_title(blocks, type_, title):
     """
-    Find the child block of page of type `type_` and title `title`.
+    Find the block in the list `blocks` of type `type_` and title `title`.
     Raises if it finds multiple matches. Returns None if not found.
     """
     results = []
-    for block in page.children:
+    for block in blocks:
         if block.type == type_ and block.title == title:
             results.append(block)
     if not results:
@@ -55,11 +131,57 @@ def get_by_type_and_title(page, type_, title):
     assert len(results) == 1, 'ERROR: found multiple matches'
     return results[0]
 
+def get_by_type_and_title(page, type_, title):
+    """
+    Find the child block of page of type `type_` and title `title`.
+    Raises if it finds multiple matches. Returns None if not found.
+    """
+    return find_by_type_and_title(page.children, type_, title)
 
-def add_issue_tracker_to_card(card, client=None):
+
+def build_children_index(pages, client):
+    """
+    Returns a dict page id --> list of child blocks for all the `pages`, loading
+    the records of all the children (and their collections) in bulk requests.
+    """
+    child_ids = [child_id for page in pages for child_id in (page.get('content') or [])]
+    for chunk_start in range(0, len(child_ids), REFRESH_RECORDS_CHUNK_SIZE):
+        client.refresh_records(block=child_ids[chunk_start:chunk_start + REFRESH_RECORDS_CHUNK_SIZE])
+    collection_ids = []
+    for child_id in child_ids:
+        child_data = client.get_record_data('block', child_id) or {}
+        if child_data.get('collection_id'):
+            collection_ids.append(child_data['collection_id'])
+    for chunk_start in range(0, len(collection_ids), REFRESH_RECORDS_CHUNK_SIZE):
+        client.refresh_records(collection=collection_ids[chunk_start:chunk_start + REFRESH_RECORDS_CHUNK_SIZE])
+    children_index = {}
+    for page in pages:
+        children_index[page.id] = [client.get_block(child_id) for child_id in (page.get('content') or [])]
+    return children_index
+
+
+def load_issue_tracker_template(client):
+    """
+    Load the data needed to create an "Issue Tracker" table from the template.
+    """
+    template_cvb = client.get_block(ISSUE_TRACKER_TEMPLATE_CVB_ID)
+    template_v = template_cvb.views[0]
+    template_col = template_cvb.collection
+    template_row = template_col.get_rows()[0]
+    return {
+        'title': template_cvb.title,
+        'schema': template_col.get('schema'),
+        'view_format': template_v.get('format'),
+        'collection_format': template_col.get('format'),
+        'sample_data': template_row.get_all_properties(),
+    }
+
+
+def add_issue_tracker_to_card(card, client=None, template=None):
     """
     Add the "Issue Tracker" table to a content source or a studio channel card.
     The input `card` can be either a CollectionRowBlock or its id (str).
+    Pass in `template` (see `load_issue_tracker_template`) to avoid reloading it.
     """
     # 0. Make sure we haz client
     if client is None:
@@ -71,48 +193,145 @@ def add_issue_tracker_to_card(card, client=None):
     assert isinstance(card, CollectionRowBlock), 'wrong assumption about card type'
 
     # 2. Check that card doesn't already have an "Issue Tracker" board
-    issue_tracker = get_by_type_and_title(card, 'collection_view', 'Issue Tracker')
+    issue_tracker = get_by_type_and_title(card, 'collection_view', ISSUE_TRACKER_TITLE)
     if issue_tracker:
         print('The card', card.title, 'already has an Issue Tracker on it.')
         return
 
     # 3. Load data from template
-    template_cvb = client.get_block(ISSUE_TRACKER_TEMPLATE_CVB_ID)
-    template_v = template_cvb.views[0]
-    template_col = template_cvb.collection
-    title = template_cvb.title
-    schema = template_col.get('schema')
-    template_v_format = template_v.get('format')
-    template_col_format = template_col.get('format')
+    if template is None:
+        template = load_issue_tracker_template(client)
+
+    _create_issue_tracker(card, client, template)
+
+
+def _create_issue_tracker(card, client, template):
+    """
+    Create the "Issue Tracker" table on `card`. The notion-py calls below each
+    open a transaction on `client`, so creation holds TRANSACTION_LOCK to keep
+    the writes of other threads out of them: trackers are created one at a time.
+    """
+    with TRANSACTION_LOCK:
+        _create_issue_tracker_table(card, client, template)
+
 
-    # 4. Add the "Issue Tracker" table
+def _create_issue_tracker_table(card, client, template):
+    # Add the "Issue Tracker" table
     cvb = card.children.add_new(CollectionViewBlock)
-    collection_id = client.create_record("collection", parent=cvb, schema=schema)
+    collection_id = client.create_record("collection", parent=cvb, schema=template['schema'])
     collection = client.get_collection(collection_id)
     table_view_id = client.create_record("collection_view", parent=cvb, type='table')
     table_view = client.get_collection_view(table_view_id, collection=collection)
     table_view.set("collection_id", collection.id)
-    table_view.set('format', template_v_format)
-    collection.set('format', template_col_format)
+    table_view.set('format', template['view_format'])
+    collection.set('format', template['collection_format'])
     cvb.set("collection_id", collection.id)
     cvb.set("view_ids", [table_view.id])
-    cvb.title = title
+    cvb.title = template['title']
 
-    # 5. Copy over the sample row
-    template_row = template_col.get_rows()[0]
-    sample_data = template_row.get_all_properties()
+    # Copy over the sample row
+    sample_data = dict(template['sample_data'])
     sample_data['created'] = datetime.now()
     row = collection.add_row(**sample_data)
 
 
+def add_issue_trackers_to_cards(cards, client=None):
+    """
+    Add the "Issue Tracker" table to all the `cards` (CollectionRowBlocks or ids)
+    that don't already have one. The template is loaded once, existing trackers
+    are found using an index of the cards' children loaded in bulk, and the new
+    trackers are created one at a time (see `_create_issue_tracker`).
+    Returns a dict card id --> 'created', 'skipped', or the exception raised.
+    """
+    if client is None:
+        client = get_notion_client(monitor=False)
+    card_ids = [card for card in cards if isinstance(card, str)]
+    for chunk_start in range(0, len(card_ids), REFRESH_RECORDS_CHUNK_SIZE):
+        client.refresh_records(block=card_ids[chunk_start:chunk_start + REFRESH_RECORDS_CHUNK_SIZE])
+    cards = [client.get_block(card) if isinstance(card, str) else card for card in cards]
+    children_index = build_children_index(cards, client)
+
+    results = {}
+    cards_todo = []
+    for card in cards:
+        if find_by_type_and_title(children_index[card.id], 'collection_view', ISSUE_TRACKER_TITLE):
+            results[card.id] = 'skipped'
+        else:
+            cards_todo.append(card)
+    LOGGER.info('Adding issue trackers to {} cards ({} already have one)'.format(
+        len(cards_todo), len(results)))
+    if not cards_todo:
+        return results
+
+    template = load_issue_tracker_template(client)
+    for card in cards_todo:
+        try:
+            _create_issue_tracker(card, client, template)
+            results[card.id] = 'created'
+        except Exception as e:
+            LOGGER.error('Failed to add issue tracker to card ' + card.id + ': ' + repr(e))
+            results[card.id] = e
+    return results
+
+
+def add_issue_trackers_to_collection(collection_url, client=None):
+    """
+    Add the "Issue Tracker" table to all the cards in the collection view `collection_url`.
+    """
+    if client is None:
+        client = get_notion_client(monitor=False)
+    cards = client.get_collection_view(collection_url).collection.get_rows()
+    return add_issue_trackers_to_cards(cards, client=client)
+
+
 # USER LOOKUP HELPER METHOD
 ################################################################################
 LE_STAFF_DATABASE_ID = 'a0557fb355464113b434cea5769286e9'
+GITHUB_TO_NOTION_LOOKUP_PATH = 'github_to_notion_users.json'
+GITHUB_TO_NOTION_LOOKUP_TTL = 24*3600   # seconds
+_github_to_notion_lookup = {'table': None, 'loaded_at': None}   # in-process memo
+_github_to_notion_lookup_lock = threading.Lock()
+
 
-def get_github_to_notion_user_lookup_table(client=None):
+def get_github_to_notion_user_lookup_table(client=None, ttl=GITHUB_TO_NOTION_LOOKUP_TTL):
     """
     Returns a dictionary of github username -> notion user ids to be used as
     part of github <> notion interations (issues and pull requests).
+    The table is built once per process and saved to GITHUB_TO_NOTION_LOOKUP_PATH,
+    and reused until it's older than `ttl` seconds. Call
+    `invalidate_github_to_notion_user_lookup_table` to force a rebuild.
+    """
+    with _github_to_notion_lookup_lock:
+        now = time.time()
+        loaded_at = _github_to_notion_lookup['loaded_at']
+        if loaded_at is not None and now - loaded_at < ttl:
+            return _github_to_notion_lookup['table']
+        if os.path.exists(GITHUB_TO_NOTION_LOOKUP_PATH) and \
+                now - os.path.getmtime(GITHUB_TO_NOTION_LOOKUP_PATH) < ttl:
+            with open(GITHUB_TO_NOTION_LOOKUP_PATH, 'r') as jsonf:
+                lookup_table = json.load(jsonf)
+            loaded_at = os.path.getmtime(GITHUB_TO_NOTION_LOOKUP_PATH)
+        else:
+            lookup_table = build_github_to_notion_user_lookup_table(client=client)
+            with open(GITHUB_TO_NOTION_LOOKUP_PATH, 'w') as jsonf:
+                json.dump(lookup_table, jsonf, indent=2)
+            loaded_at = now
+        _github_to_notion_lookup['table'] = lookup_table
+        _github_to_notion_lookup['loaded_at'] = loaded_at
+        return lookup_table
+
+
+def invalidate_github_to_notion_user_lookup_table():
+    with _github_to_notion_lookup_lock:
+        _github_to_notion_lookup['table'] = None
+        _github_to_notion_lookup['loaded_at'] = None
+        if os.path.exists(GITHUB_TO_NOTION_LOOKUP_PATH):
+            os.remove(GITHUB_TO_NOTION_LOOKUP_PATH)
+
+
+def build_github_to_notion_user_lookup_table(client=None):
+    """
+    Build the github username -> notion user id lookup table from the LE staff database.
     """
     if client is None:
         client = get_notion_client(monitor=False)
@@ -121,35 +340,174 @@ def get_github_to_notion_user_lookup_table(client=None):
     lookup_table = {}
     for user in col.get_rows():
         notion_person = user.get_property('notion_person')
-        if notion_person:
-            notion_user_id = notion_person[0].id
-        github_username = user.get_property('github_username').strip()
+        if not notion_person:
+            continue
+        notion_user_id = notion_person[0].id
+        github_username = (user.get_property('github_username') or '').strip()
         if github_username and notion_user_id:
             lookup_table[github_username] = notion_user_id
     return lookup_table
 
-# GITHUB_TO_NOTION_USER_LOOKUP_TABLE = get_github_to_notion_user_lookup_table()
-
 
 
 # Get channel data
 ################################################################################
+STUDIO_CHANNELS_URL = 'https://www.notion.so/learningequality/761249f8782c48289780d6693431d900?v=44827975ce5f4b23b5157381fac302c4'
+STUDIO_CHANNELS_SNAPSHOT_PATH = 'notion_channels_snapshot.json'
+SNAPSHOT_FULL_REFRESH_AGE = 24*3600   # seconds between full refreshes (to drop deleted rows)
+
+
+def add_record_to_store(client, table, record_id, data):
+    """
+    Put the record `data` in the local record store of `client` so that reading
+    it makes no request. This uses the private `RecordStore._update_record`
+    method, checked against notion-py 0.0.25 to 0.0.28. Returns False (and the
+    record must be loaded with a request) if the method is not available.
+    """
+    try:
+        client._store._update_record(table, record_id, value=data)
+        return True
+    except (AttributeError, TypeError) as e:
+        LOGGER.warning('Could not add record to the notion-py record store: ' + repr(e))
+        return False
+
+
+
+def parse_channel_id(channel_id):
+    """
+    Extract the channel_id from the value of a card's `channel_id` property,
+    which is sometimes written as `[channel_id]` or as a link.
+    """
+    if channel_id and '[' in channel_id and ']' in channel_id:
+        channel_id = channel_id.split('[')[1].split(']')[0]
+    return channel_id
+
+
+class CollectionSnapshot(object):
+    """
+    Local copy of the records of the rows of a notion collection, saved to the
+    json file `path`, so the rows don't need to be downloaded on every run.
+    If the collection has a property of type `last_edited_time`, `refresh` only
+    queries for the rows edited since the last refresh, and does a full refresh
+    every `SNAPSHOT_FULL_REFRESH_AGE` seconds to forget about deleted rows.
+    """
+
+    def __init__(self, path, view_url):
+        self.path = path
+        self.view_url = view_url
+        self.rows = {}             # row id --> notion record data
+        self.synced_at = None      # time of last refresh
+        self.full_synced_at = None # time of last full refresh
+        if os.path.exists(path):
+            with open(path, 'r') as jsonf:
+                data = json.load(jsonf)
+            if data.get('view_url') == view_url:
+                self.rows = data['rows']
+                self.synced_at = data['synced_at']
+                self.full_synced_at = data['full_synced_at']
+
+    def save(self):
+        data = {
+            'view_url': self.view_url,
+            'rows': self.rows,
+            'synced_at': self.synced_at,
+            'full_synced_at': self.full_synced_at,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as jsonf:
+            json.dump(data, jsonf)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self, client):
+        """
+        Update the snapshot with the rows that changed since the last refresh,
+        and returns the list of all rows (CollectionRowBlock objects).
+        """
+        view = client.get_collection_view(self.view_url)
+        collection = view.collection
+        now = time.time()
+        edited_rows = None
+        full_refresh_due = self.full_synced_at is None or now - self.full_synced_at > SNAPSHOT_FULL_REFRESH_AGE
+        if not full_refresh_due:
+            edited_rows = self._query_edited_rows(collection)
+        if edited_rows is None:
+            LOGGER.info('Full refresh of collection snapshot ' + self.path)
+            self.rows = {}
+            edited_rows = collection.get_rows()
+            self.full_synced_at = now
+        for row in edited_rows:
+            self.rows[row.id] = client.get_record_data('block', row.id)
+        self.rows = dict((row_id, data) for row_id, data in self.rows.items() if data.get('alive', True))
+        self.synced_at = now
+        self.save()
+        return self.get_rows(client)
+
+    def _query_edited_rows(self, collection):
+        """
+        Query only the rows edited since the last refresh (since the start of
+        that day since notion date filters have day granularity). Returns None
+        if the collection doesn't have a `last_edited_time` property to filter on.
+        """
+        schema = collection.get('schema')
+        edited_props = [prop_id for prop_id, prop in schema.items() if prop['type'] == 'last_edited_time']
+        if not edited_props:
+            LOGGER.warning('Collection ' + collection.id + ' has no last_edited_time property, '
+                           'doing a full refresh of snapshot ' + self.path)
+            return None
+        since_date = datetime.fromtimestamp(self.synced_at).strftime('%Y-%m-%d')
+        # filter format of the queryCollection API used by notion-py 0.0.25
+        filter_params = [{
+            'property': edited_props[0],
+            'comparator': 'date_is_on_or_after',
+            'value': {'type': 'exact', 'value': {'type': 'date', 'start_date': since_date}},
+        }]
+        try:
+            edited_rows = collection.query(filter=filter_params)
+        except Exception as e:
+            LOGGER.warning('Could not query edited rows, doing a full refresh of snapshot '
+                           + self.path + ': ' + repr(e))
+            return None
+        LOGGER.info('Found {} rows edited since {} ({} rows in snapshot {})'.format(
+            len(edited_rows), since_date, len(self.rows), self.path))
+        return edited_rows
+
+    def get_rows(self, client):
+        """
+        Returns the rows in the snapshot as CollectionRowBlock objects. The row
+        records are added to the client's record store so no requests are made,
+        or loaded in bulk requests if that's not possible (see `add_record_to_store`).
+        """
+        row_ids = list(self.rows.keys())
+        if not all(add_record_to_store(client, 'block', row_id, self.rows[row_id]) for row_id in row_ids):
+            for chunk_start in range(0, len(row_ids), REFRESH_RECORDS_CHUNK_SIZE):
+                client.refresh_records(block=row_ids[chunk_start:chunk_start + REFRESH_RECORDS_CHUNK_SIZE])
+        return [client.get_block(row_id) for row_id in row_ids]
+
+    def get_rows_by_channel_id(self, client):
+        results = {}
+        for row in self.get_rows(client):
+            channel_id = parse_channel_id(row.get_property('channel_id'))
+            if channel_id:
+                results[channel_id] = row
+        return results
+
+
+def get_studio_channels_snapshot(client=None):
+    """
+    Returns the snapshot of the "Studio Channels" collection after refreshing it.
+    """
+    if client is None:
+        client = get_notion_client(monitor=False)
+    snapshot = CollectionSnapshot(STUDIO_CHANNELS_SNAPSHOT_PATH, STUDIO_CHANNELS_URL)
+    snapshot.refresh(client)
+    return snapshot
+
+
 def get_channel_data_by_channel_id(client=None):
     """
     Returns json data for all channels. Use to cache results so will run faster.
     """
     if client is None:
         client = get_notion_client(monitor=False)
-    # Suudio Channels All Channels view
-    studio_channels_url = 'https://www.notion.so/learningequality/761249f8782c48289780d6693431d900?v=44827975ce5f4b23b5157381fac302c4'
-    studio_channles_view = client.get_collection_view(studio_channels_url)
-    studio_channels = studio_channles_view.collection.get_rows()
-    #
-    results = {}
-    for studio_channel in studio_channels:
-        channel_id = studio_channel.get_property('channel_id')
-        if '[' in channel_id and ']' in channel_id:
-            channel_id = channel_id.split('[')[1].split(']')[0]
-        if channel_id:
-            results[channel_id] = studio_channel
-    return results
+    snapshot = get_studio_channels_snapshot(client=client)
+    return snapshot.get_rows_by_channel_id(client)
@@ -0,0 +1,176 @@
+import json
+import logging as LOGGER
+import sqlite3
+import time
+
+from libnotion import parse_channel_id
+
+
+# CHANNEL REGISTRY
+################################################################################
+CHANNEL_REGISTRY_PATH = 'channel_registry.sqlite3'
+REGISTRY_MAX_AGE = 24*3600   # seconds before the Studio info of a channel is refetched
+
+
+def make_fts_query(text):
+    """
+    Returns an FTS5 query that matches all the words in the user text `text`,
+    each quoted as a phrase so characters like `-`, `:`, or `*` are not parsed
+    as FTS5 query syntax (e.g. `grade-5` matches the phrase "grade 5").
+    """
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+
+class ChannelRegistry(object):
+    """
+    Local SQLite database of channels that joins the fields of the cards in the
+    "Studio Channels" notion board with the channel info from the Studio API.
+    Has indexes on channel_id, language, and public, and a full-text index on
+    the channel name and description, so exports and searches don't need to
+    call the APIs except for channels whose Studio info is stale.
+    """
+
+    def __init__(self, path=CHANNEL_REGISTRY_PATH, max_age=REGISTRY_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS channels (
+                                channel_id TEXT PRIMARY KEY,
+                                card_id TEXT,
+                                card_name TEXT,
+                                card_edited_time INTEGER,
+                                name TEXT,
+                                description TEXT,
+                                language TEXT,
+                                public INTEGER,
+                                version INTEGER,
+                                studio_data TEXT,
+                                studio_fetched_at REAL)""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS channels_language ON channels (language)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS channels_public ON channels (public)')
+        self.conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5(
+                                name, description, content='channels', content_rowid='rowid')""")
+        self.conn.executescript("""
+            CREATE TRIGGER IF NOT EXISTS channels_ai AFTER INSERT ON channels BEGIN
+                INSERT INTO channels_fts(rowid, name, description) VALUES (new.rowid, new.name, new.description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS channels_ad AFTER DELETE ON channels BEGIN
+                INSERT INTO channels_fts(channels_fts, rowid, name, description)
+                    VALUES ('delete', old.rowid, old.name, old.description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS channels_au AFTER UPDATE ON channels BEGIN
+                INSERT INTO channels_fts(channels_fts, rowid, name, description)
+                    VALUES ('delete', old.rowid, old.name, old.description);
+                INSERT INTO channels_fts(rowid, name, description) VALUES (new.rowid, new.name, new.description);
+            END;
+        """)
+        self.conn.commit()
+
+    def update_cards(self, notion_channels):
+        """
+        Add or update the notion card fields for the list of all the rows of
+        the notion board `notion_channels`, and remove channels not in the list.
+        """
+        seen_channel_ids = set()
+        with self.conn:
+            for notion_channel in notion_channels:
+                channel_id = parse_channel_id(notion_channel.get_property('channel_id'))
+                if not channel_id or len(channel_id) != 32:
+                    continue  # skip cards that don't have a valid-looking channel_id
+                seen_channel_ids.add(channel_id)
+                self.conn.execute("""INSERT INTO channels (channel_id, card_id, card_name, card_edited_time)
+                                     VALUES (?, ?, ?, ?)
+                                     ON CONFLICT(channel_id) DO UPDATE SET
+                                        card_id=excluded.card_id,
+                                        card_name=excluded.card_name,
+                                        card_edited_time=excluded.card_edited_time""",
+                                  (channel_id, notion_channel.id, notion_channel.get_property('name'),
+                                   notion_channel.get('last_edited_time')))
+            # remove channels whose cards were deleted from the notion board
+            for row in self.conn.execute('SELECT channel_id FROM channels').fetchall():
+                if row['channel_id'] not in seen_channel_ids:
+                    self.conn.execute('DELETE FROM channels WHERE channel_id=?', (row['channel_id'],))
+
+    def update_studio_info(self, channel_data, fetched_at=None):
+        """
+        Save the channel info `channel_data` returned by `StudioApi.get_channel`.
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+        with self.conn:
+            self.conn.execute("""INSERT INTO channels (channel_id, name, description, language, public,
+                                                       version, studio_data, studio_fetched_at)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                 ON CONFLICT(channel_id) DO UPDATE SET
+                                    name=excluded.name,
+                                    description=excluded.description,
+                                    language=excluded.language,
+                                    public=excluded.public,
+                                    version=excluded.version,
+                                    studio_data=excluded.studio_data,
+                                    studio_fetched_at=excluded.studio_fetched_at""",
+                              (channel_data['id'], channel_data.get('name'), channel_data.get('description'),
+                               channel_data.get('language'), channel_data.get('public'),
+                               channel_data.get('version'), json.dumps(channel_data), fetched_at))
+
+    def refresh_stale(self, studio_api, channel_ids=None):
+        """
+        Fetch the Studio info for the channels (all or only `channel_ids`) that
+        have no Studio info or whose Studio info is older than `max_age`.
+        Returns the dict of channel_id --> exception for channels that failed.
+        """
+        stale_before = time.time() - self.max_age
+        rows = self.conn.execute('SELECT channel_id FROM channels '
+                                 'WHERE studio_fetched_at IS NULL OR studio_fetched_at < ?',
+                                 (stale_before,)).fetchall()
+        stale_ids = [row['channel_id'] for row in rows]
+        if channel_ids is not None:
+            channel_ids = set(channel_ids)
+            stale_ids = [channel_id for channel_id in stale_ids if channel_id in channel_ids]
+        if not stale_ids:
+            return {}
+        LOGGER.info('Refreshing Studio info for {} stale channels'.format(len(stale_ids)))
+        channels, errors = studio_api.get_channels(stale_ids)
+        fetched_at = time.time()
+        for channel_data in channels:
+            if channel_data is not None and 'id' in channel_data:
+                self.update_studio_info(channel_data, fetched_at=fetched_at)
+        return errors
+
+    def search(self, text=None, name_contains=None, language=None, public=None):
+        """
+        Returns the list of channels (dicts with the columns of the registry)
+        that match all the criteria given:
+          - `text`: words to search for in the channel name and description (all
+            words must match; FTS5 syntax characters are matched literally)
+          - `name_contains`: substring of the name of the notion card
+          - `language`: language code of the channel
+          - `public`: True or False
+        """
+        sql = 'SELECT channels.* FROM channels'
+        conditions = []
+        params = []
+        if text and text.strip():
+            sql += ' JOIN channels_fts ON channels_fts.rowid = channels.rowid'
+            conditions.append('channels_fts MATCH ?')
+            params.append(make_fts_query(text))
+        if name_contains:
+            conditions.append('instr(channels.card_name, ?) > 0')
+            params.append(name_contains)
+        if language is not None:
+            conditions.append('channels.language = ?')
+            params.append(language)
+        if public is not None:
+            conditions.append('channels.public = ?')
+            params.append(1 if public else 0)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY channels.card_name'
+        results = []
+        for row in self.conn.execute(sql, params):
+            result = dict(row)
+            if result['studio_data']:
+                result['studio_data'] = json.loads(result['studio_data'])
+            results.append(result)
+        return results
@@ -1,11 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import logging as LOGGER
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
 
 
 # DEFAULT_STUDIO_URL = 'https://develop.studio.learningequality.org'
 DEFAULT_STUDIO_URL = 'http://127.0.0.1:8080'
 # DEFAULT_STUDIO_URL = 'https://studio.learningequality.org'
 
+NODES_CHUNK_SIZE = 25    # number of studio_ids to GET in each get_nodes_by_ids_complete call
+MAX_WORKERS = 8          # max number of concurrent GET requests when fetching trees by level
+
+CHANNELS_RATE_LIMIT = 10     # max number of channel requests per second in get_channels
+MUTATIONS_BATCH_SIZE = 100   # max number of nodes per PUT/POST request in MutationBatcher
+
+# HTTP transport settings
+POOL_SIZE = 16                                   # max keep-alive connections per host
+MAX_RETRIES = 5
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT']      # POSTs are only retried on 429 (request not processed)
+BACKOFF_BASE = 0.5                               # seconds
+BACKOFF_MAX = 30                                 # seconds
+
+# Response cache settings
+DEFAULT_CACHE_PATH = 'studio_cache.sqlite3'
+CACHE_TTL = 24*3600                              # seconds before a cached response must be revalidated
+CACHE_MAX_BYTES = 512*1024*1024                  # least recently used responses evicted above this size
+LICENSES_CACHE_PATH = 'studio_licenses.json'
+LICENSES_MAX_AGE = 7*24*3600                     # seconds before the licenses table is downloaded again
+
+# Instrumentation settings
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]   # seconds
+
 
 # TODO https://studio.learningequality.org/api/get_node_path/ca8f380/18932/41b2549
 # TODO https://studio.learningequality.org/api/language
@@ -18,10 +51,22 @@ class StudioApi(object):
     corrections, and other automation.
     """
 
-    def __init__(self, token, username=None, password=None, studio_url=DEFAULT_STUDIO_URL):
+    def __init__(self, token, username=None, password=None, studio_url=DEFAULT_STUDIO_URL,
+                 cache_path=None, cache_ttl=CACHE_TTL, cache_max_bytes=CACHE_MAX_BYTES,
+                 licenses_cache_path=LICENSES_CACHE_PATH):
         self.studio_url = studio_url.rstrip('/')
         self.token = token
-        self.licenses_by_id = self.get_licenses()
+        self.stats = RequestStats()
+        if cache_path:
+            self.cache = ResponseCache(cache_path, ttl=cache_ttl, max_bytes=cache_max_bytes,
+                                       namespace=self.studio_url)
+        else:
+            self.cache = None
+        self.token_session = create_pooled_session()
+        self.token_session.headers.update({"Authorization": "Token {0}".format(self.token)})
+        self.trash_tree_ids = {}
+        self.licenses_cache_path = licenses_cache_path
+        self._licenses_by_id = None   # loaded on first access of `licenses_by_id`
         if username and password:
             self.session = self._create_logged_in_session(username, password)
         else:
@@ -29,7 +74,7 @@ class StudioApi(object):
 
     def _create_logged_in_session(self, username, password):
         LOGIN_ENDPOINT = self.studio_url + '/accounts/login/'
-        session = requests.session()
+        session = create_pooled_session()
         session.headers.update({"referer": self.studio_url})
         session.headers.update({'User-Agent': 'Mozilla/5.0 Firefox/63.0'})
         session.get(LOGIN_ENDPOINT)
@@ -45,6 +90,66 @@ class StudioApi(object):
         assert response2.status_code == 200, 'Login POST failed'
         return session
 
+    def _request(self, method, url, session=None, **kwargs):
+        """
+        Make a HTTP request using `session` (defaults to the token-auth session).
+        Responses with status in `RETRY_STATUS_CODES` and connection errors are
+        retried up to `MAX_RETRIES` times using jittered exponential backoff.
+        """
+        if session is None:
+            session = self.token_session
+        endpoint = get_endpoint_name(url)
+        for attempt in range(MAX_RETRIES + 1):
+            retryable = attempt < MAX_RETRIES
+            if attempt > 0:
+                self.stats.record_retry(endpoint)
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                self.stats.record_request(endpoint, time.monotonic() - start, 0)
+                if not retryable or method not in IDEMPOTENT_METHODS:
+                    raise
+                reason = str(e)
+                delay = get_backoff_delay(attempt)
+            else:
+                self.stats.record_request(endpoint, time.monotonic() - start, len(response.content))
+                should_retry = response.status_code == 429 or \
+                    (response.status_code in RETRY_STATUS_CODES and method in IDEMPOTENT_METHODS)
+                if not should_retry or not retryable:
+                    return response
+                reason = 'status ' + str(response.status_code)
+                delay = get_backoff_delay(attempt, retry_after=response.headers.get('Retry-After'))
+            LOGGER.warning('  retrying {} {} in {:.1f}s ({})'.format(method, url, delay, reason))
+            time.sleep(delay)
+
+    def _get_json(self, endpoint, key, url, session=None):
+        """
+        GET the JSON data from `url`, going through the response cache (if
+        enabled) under `endpoint` and `key`. Stale cache entries are revalidated
+        using the ETag and Last-Modified headers when Studio provided them.
+        """
+        entry = self.cache.get(endpoint, key) if self.cache else None
+        if entry and entry['fresh']:
+            self.stats.record_cache_hit(endpoint)
+            return entry['data']
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        LOGGER.info('  GET ' + url)
+        response = self._request('GET', url, session=session, headers=headers)
+        if entry and response.status_code == 304:
+            self.stats.record_cache_hit(endpoint)
+            self.cache.touch(endpoint, key)
+            return entry['data']
+        data = response.json()
+        if self.cache and response.status_code == 200:
+            self.cache.set(endpoint, key, data, etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'))
+        return data
+
 
     def get_channel(self, channel_id):
         """
@@ -62,11 +167,34 @@ class StudioApi(object):
         # TODO: add TokenAuth to this entpoint so can use without session login
         # headers = {"Authorization": "Token {0}".format(self.token)}
         url = CHANNEL_ENDPOINT + channel_id
-        LOGGER.info('  GET ' + url)
-        response = self.session.get(url)
-        channel_data = response.json()
+        channel_data = self._get_json('channel', channel_id, url, session=self.session)
         return channel_data
 
+    def get_channels(self, channel_ids, max_workers=MAX_WORKERS, rate_limit=CHANNELS_RATE_LIMIT):
+        """
+        Get the channel info for all channels in `channel_ids` using concurrent
+        calls to `get_channel`, making at most `rate_limit` requests per second.
+        Returns a tuple `(channels, errors)` where `channels` is a list of the
+        channel data in the same order as `channel_ids` (None for channels that
+        failed), and `errors` is a dict of channel_id --> exception raised.
+        """
+        rate_limiter = RateLimiter(rate_limit, burst=max_workers)
+        def _get_channel(channel_id):
+            rate_limiter.acquire()
+            return self.get_channel(channel_id)
+        channels = []
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_get_channel, channel_id) for channel_id in channel_ids]
+            for channel_id, future in zip(channel_ids, futures):
+                try:
+                    channels.append(future.result())
+                except Exception as e:
+                    LOGGER.error('Failed to get channel ' + channel_id + ': ' + repr(e))
+                    channels.append(None)
+                    errors[channel_id] = e
+        return channels, errors
+
     def get_channel_root_studio_id(self, channel_id, tree='main'):
         """
         Return the `studio_id` for the root of the tree `tree` for `channel_id`.
@@ -77,11 +205,46 @@ class StudioApi(object):
         return tree_data['id']
 
 
+    @property
+    def licenses_by_id(self):
+        """
+        Dictionary of Studio licenses by license id. Loaded on first access from
+        the local file `licenses_cache_path` if it is recent enough and was saved
+        for the same studio_url, otherwise downloaded and saved to that file.
+        """
+        if self._licenses_by_id is None:
+            self._licenses_by_id = self._load_cached_licenses()
+        if self._licenses_by_id is None:
+            self._licenses_by_id = self.get_licenses()
+            self._save_cached_licenses(self._licenses_by_id)
+        return self._licenses_by_id
+
+    def _load_cached_licenses(self):
+        if not self.licenses_cache_path or not os.path.exists(self.licenses_cache_path):
+            return None
+        if time.time() - os.path.getmtime(self.licenses_cache_path) > LICENSES_MAX_AGE:
+            return None
+        try:
+            with open(self.licenses_cache_path, 'r') as jsonf:
+                cached = json.load(jsonf)
+        except ValueError:
+            return None
+        if cached.get('studio_url') != self.studio_url:
+            return None
+        return dict((license['id'], license) for license in cached['licenses'])
+
+    def _save_cached_licenses(self, licenses_dict):
+        if not self.licenses_cache_path:
+            return
+        cached = {'studio_url': self.studio_url, 'licenses': list(licenses_dict.values())}
+        tmp_path = self.licenses_cache_path + '.tmp'
+        with open(tmp_path, 'w') as jsonf:
+            json.dump(cached, jsonf)
+        os.replace(tmp_path, self.licenses_cache_path)
+
     def get_licenses(self):
         LICENSES_LIST_ENDPOINT = self.studio_url + '/api/license'
-        headers = {"Authorization": "Token {0}".format(self.token)}
-        response = requests.get(LICENSES_LIST_ENDPOINT, headers=headers)
-        licenses_list = response.json()
+        licenses_list = self._get_json('license', 'all', LICENSES_LIST_ENDPOINT)
         licenses_dict = {}
         for license in licenses_list:
             licenses_dict[license['id']] = license
@@ -93,29 +256,59 @@ class StudioApi(object):
         Get the complete JSON representation of a content node from the Studio API.
         """
         NODES_ENDPOINT = self.studio_url + '/api/get_nodes_by_ids_complete/'
-        headers = {"Authorization": "Token {0}".format(self.token)}
         url = NODES_ENDPOINT + studio_id
-        LOGGER.info('  GET ' + url)
-        response = requests.get(url, headers=headers)
-        studio_node = response.json()[0]
+        studio_node = self._get_json('get_nodes_by_ids_complete', studio_id, url)[0]
         return studio_node
 
+    def _get_nodes_chunk(self, studio_ids, use_cache=True):
+        """
+        GET the node data for the list `studio_ids` in a single API call.
+        Nodes found fresh in the response cache are not requested. Each fetched
+        node is cached under its own id, the same as `get_nodes_by_ids_complete`.
+        """
+        NODES_ENDPOINT = self.studio_url + '/api/get_nodes_by_ids_complete/'
+        nodes_by_id = {}
+        missing_ids = []
+        for studio_id in studio_ids:
+            entry = self.cache.get('get_nodes_by_ids_complete', studio_id) if self.cache and use_cache else None
+            if entry and entry['fresh'] and entry['data']:
+                self.stats.record_cache_hit('get_nodes_by_ids_complete')
+                nodes_by_id[studio_id] = entry['data'][0]
+            else:
+                missing_ids.append(studio_id)
+        if missing_ids:
+            url = NODES_ENDPOINT + ','.join(missing_ids)
+            LOGGER.info('  GET ' + url)
+            response = self._request('GET', url)
+            for node in response.json():
+                nodes_by_id[node['id']] = node
+                if self.cache:
+                    self.cache.set('get_nodes_by_ids_complete', node['id'], [node])
+        return [nodes_by_id[studio_id] for studio_id in studio_ids if studio_id in nodes_by_id]
+
+    def get_nodes_by_ids(self, studio_ids, use_cache=True,
+                         chunk_size=NODES_CHUNK_SIZE, max_workers=MAX_WORKERS):
+        """
+        Get the data for the list of nodes `studio_ids` (without following their
+        children) using concurrent requests of `chunk_size` nodes each.
+        Set `use_cache=False` to get the current data from Studio.
+        """
+        chunks = split_into_chunks(studio_ids, chunk_size)
+        studio_nodes = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk_nodes in executor.map(lambda chunk: self._get_nodes_chunk(chunk, use_cache), chunks):
+                studio_nodes.extend(chunk_nodes)
+        return studio_nodes
+
     def get_nodes_by_ids_bulk(self, studio_ids):
         """
         A more efficient version of `get_nodes_by_ids_complete` that GETs tree
-        content node data in chunks of 10 from the Studio API.
+        content node data in chunks of 25 from the Studio API.
         """
-        CHUNK_SIZE = 25
-        NODES_ENDPOINT = self.studio_url + '/api/get_nodes_by_ids_complete/'
-        headers = {"Authorization": "Token {0}".format(self.token)}
         studio_nodes = []
-        studio_ids_chunks = [studio_ids[i:i+CHUNK_SIZE] for i in range(0, len(studio_ids), CHUNK_SIZE)]
+        studio_ids_chunks = split_into_chunks(studio_ids, NODES_CHUNK_SIZE)
         for studio_ids_chunk in studio_ids_chunks:
-            studio_ids_csv = ','.join(studio_ids_chunk)
-            url = NODES_ENDPOINT + studio_ids_csv
-            LOGGER.info('  GET ' + url)
-            response = requests.get(url, headers=headers)
-            chunk_nodes = response.json()
+            chunk_nodes = self._get_nodes_chunk(studio_ids_chunk)
             for chunk_node in chunk_nodes:
                 if 'children' in chunk_node:
                     child_nodes = self.get_nodes_by_ids_bulk(chunk_node['children'])
@@ -123,17 +316,73 @@ class StudioApi(object):
             studio_nodes.extend(chunk_nodes)
         return studio_nodes
 
-    def get_tree_for_studio_id(self, studio_id):
+    def get_nodes_by_level(self, parent_nodes, chunk_size=NODES_CHUNK_SIZE, max_workers=MAX_WORKERS):
+        """
+        Breadth-first version of `get_nodes_by_ids_bulk`: replaces the list of
+        children ids of each node in `parent_nodes` with the child nodes data.
+        All child ids of one level of the tree are collected, split into chunks
+        of size `chunk_size`, and fetched using a pool of `max_workers` threads,
+        so the total number of sequential round trips is the depth of the tree.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            level = [node for node in parent_nodes if 'children' in node]
+            while level:
+                child_ids = [child_id for node in level for child_id in node['children']]
+                chunks = split_into_chunks(child_ids, chunk_size)
+                nodes_by_id = {}
+                for chunk_nodes in executor.map(self._get_nodes_chunk, chunks):
+                    for chunk_node in chunk_nodes:
+                        nodes_by_id[chunk_node['id']] = chunk_node
+                next_level = []
+                for node in level:
+                    child_nodes = [nodes_by_id[child_id] for child_id in node['children']
+                                   if child_id in nodes_by_id]
+                    node['children'] = child_nodes
+                    next_level.extend(child for child in child_nodes if 'children' in child)
+                level = next_level
+        return parent_nodes
+
+    def get_tree_for_studio_id(self, studio_id, breadth_first=False,
+                               chunk_size=NODES_CHUNK_SIZE, max_workers=MAX_WORKERS):
         """
         Returns the full json tree (recusive calls to /api/get_nodes_by_ids_complete)
+        Set `breadth_first=True` to fetch the tree one level at a time using
+        concurrent requests (see `get_nodes_by_level`); the result is the same.
         """
         channel_root = self.get_nodes_by_ids_complete(studio_id)
-        if 'children' in channel_root:
+        if breadth_first:
+            self.get_nodes_by_level([channel_root], chunk_size=chunk_size, max_workers=max_workers)
+        elif 'children' in channel_root:
             children_refs = channel_root['children']
             studio_nodes = self.get_nodes_by_ids_bulk(children_refs)
             channel_root['children'] = studio_nodes
         return channel_root
 
+    def iter_tree(self, studio_id, chunk_size=NODES_CHUNK_SIZE):
+        """
+        Generator that yields `(node, parent_id, depth)` tuples for all nodes in
+        the tree rooted at `studio_id` as they are fetched (chunks of siblings are
+        fetched in depth-first order).
+        The `children` of each node are left as a list of studio_ids. Only the
+        lists of children ids waiting to be fetched are kept in memory, so memory
+        use is bounded by the chunk size and the tree depth, not the tree size.
+        """
+        root = self.get_nodes_by_ids_complete(studio_id)
+        yield root, None, 0
+        stack = []   # entries are (parent_id, depth, child_ids) still to be fetched
+        if root.get('children'):
+            stack.append((root['id'], 1, root['children']))
+        while stack:
+            parent_id, depth, child_ids = stack.pop()
+            if len(child_ids) > chunk_size:
+                stack.append((parent_id, depth, child_ids[chunk_size:]))
+            chunk_nodes = self._get_nodes_chunk(child_ids[0:chunk_size])
+            for chunk_node in chunk_nodes:
+                yield chunk_node, parent_id, depth
+            for chunk_node in reversed(chunk_nodes):
+                if chunk_node.get('children'):
+                    stack.append((chunk_node['id'], depth + 1, chunk_node['children']))
+
 
     def get_contentnode(self, studio_id):
         """
@@ -145,15 +394,8 @@ class StudioApi(object):
         """
         Send a PUT requests to /api/contentnode to update Studio node to data.
         """
-        CONTENTNODE_ENDPOINT = self.studio_url + '/api/contentnode'
-        REQUIRED_FIELDS = ['id', 'tags', 'prerequisite', 'parent']
-        assert data_has_required_keys(data, REQUIRED_FIELDS), 'missing necessary attributes'        
-        # studio_id = data['id']
-        url = CONTENTNODE_ENDPOINT
-        print('  semantic PATCH using PUT ' + url)
-        csrftoken = self.session.cookies.get("csrftoken")
-        self.session.headers.update({"x-csrftoken": csrftoken})
-        response = self.session.put(url, json=[data])
+        print('  semantic PATCH using PUT ' + self.studio_url + '/api/contentnode')
+        response = self.put_contentnodes([data])
         node_data = response.json()
         return node_data
 
@@ -164,22 +406,10 @@ class StudioApi(object):
         can provide `trash_studio_id` which is the studio id the trash tree for
         the channel.
         """
-        MOVE_NODES_ENDPOINT =    self.studio_url + '/api/move_nodes/'
-        REQUIRED_FIELDS = ['id']
-        assert data_has_required_keys(data, REQUIRED_FIELDS), 'missing necessary attributes'
         if trash_studio_id is None:
-            channel_data = self.get_channel(channel_id)
-            trash_studio_id = channel_data['trash_tree']['id']
-        post_data = {
-            'nodes': [data],
-            'target_parent': trash_studio_id,
-            'channel_id': channel_id,
-        }
-        url = MOVE_NODES_ENDPOINT
-        print('  semantic DELETE using POST to ' + url)
-        csrftoken = self.session.cookies.get("csrftoken")
-        self.session.headers.update({"x-csrftoken": csrftoken})
-        response = self.session.post(url, json=post_data)
+            trash_studio_id = self.get_trash_tree_id(channel_id)
+        print('  semantic DELETE using POST to ' + self.studio_url + '/api/move_nodes/')
+        response = self.move_contentnodes([data], trash_studio_id, channel_id)
         deleted_datas = response.json()
         return deleted_datas
 
@@ -188,24 +418,501 @@ class StudioApi(object):
         Send a POST requests to /api/duplicate_node_inline/ to copy node `data`
         to the target parent folder `target_parent` in channel `channel_id`.
         """
-        DUPLICATE_NODE_INLINE_ENDPOINT = self.studio_url + '/api/duplicate_nodes/'
+        print('  semantic COPY using POST to ' + self.studio_url + '/api/duplicate_nodes/')
+        response = self.duplicate_contentnodes([data], target_parent, channel_id)
+        print(response.content)
+        copied_data_list = response.json()
+        return copied_data_list
+
+    def get_trash_tree_id(self, channel_id):
+        """
+        Return the studio_id of the trash tree for `channel_id` (cached per channel).
+        """
+        if channel_id not in self.trash_tree_ids:
+            channel_data = self.get_channel(channel_id)
+            self.trash_tree_ids[channel_id] = channel_data['trash_tree']['id']
+        return self.trash_tree_ids[channel_id]
+
+    def _set_csrf_header(self):
+        csrftoken = self.session.cookies.get("csrftoken")
+        self.session.headers.update({"x-csrftoken": csrftoken})
+
+    def put_contentnodes(self, datas):
+        """
+        Update the list of Studio nodes `datas` using a single PUT request to
+        /api/contentnode. Returns the response object.
+        """
+        CONTENTNODE_ENDPOINT = self.studio_url + '/api/contentnode'
+        REQUIRED_FIELDS = ['id', 'tags', 'prerequisite', 'parent']
+        for data in datas:
+            assert data_has_required_keys(data, REQUIRED_FIELDS), 'missing necessary attributes'
+        self._set_csrf_header()
+        response = self._request('PUT', CONTENTNODE_ENDPOINT, session=self.session, json=datas)
+        self._invalidate_nodes([data['id'] for data in datas] + [data['parent'] for data in datas])
+        return response
+
+    def move_contentnodes(self, datas, target_parent, channel_id):
+        """
+        Move the list of Studio nodes `datas` under `target_parent` in channel
+        `channel_id` using a single POST request to /api/move_nodes/.
+        Returns the response object.
+        """
+        MOVE_NODES_ENDPOINT = self.studio_url + '/api/move_nodes/'
         REQUIRED_FIELDS = ['id']
-        assert data_has_required_keys(data, REQUIRED_FIELDS), 'no studio_id in data'
+        for data in datas:
+            assert data_has_required_keys(data, REQUIRED_FIELDS), 'missing necessary attributes'
         post_data = {
-            'node_ids': [data['id']],
+            'nodes': datas,
             'target_parent': target_parent,
             'channel_id': channel_id,
         }
-        url = DUPLICATE_NODE_INLINE_ENDPOINT
-        print('  semantic COPY using POST to ' + url)
-        csrftoken = self.session.cookies.get("csrftoken")
-        self.session.headers.update({"x-csrftoken": csrftoken})
-        response = self.session.post(url, json=post_data)
-        print(response.content)
-        copied_data_list = response.json()
-        return copied_data_list
+        self._set_csrf_header()
+        response = self._request('POST', MOVE_NODES_ENDPOINT, session=self.session, json=post_data)
+        self._invalidate_nodes([data['id'] for data in datas] +
+                               [data.get('parent') for data in datas] + [target_parent])
+        return response
+
+    def duplicate_contentnodes(self, datas, target_parent, channel_id):
+        """
+        Copy the list of Studio nodes `datas` to the folder `target_parent` in
+        channel `channel_id` using a single POST request to /api/duplicate_nodes/.
+        Returns the response object.
+        """
+        DUPLICATE_NODES_ENDPOINT = self.studio_url + '/api/duplicate_nodes/'
+        REQUIRED_FIELDS = ['id']
+        for data in datas:
+            assert data_has_required_keys(data, REQUIRED_FIELDS), 'no studio_id in data'
+        post_data = {
+            'node_ids': [data['id'] for data in datas],
+            'target_parent': target_parent,
+            'channel_id': channel_id,
+        }
+        self._set_csrf_header()
+        response = self._request('POST', DUPLICATE_NODES_ENDPOINT, session=self.session, json=post_data)
+        self._invalidate_nodes([target_parent])
+        return response
+
+    def _invalidate_nodes(self, studio_ids):
+        """
+        Remove the cached data for nodes `studio_ids` after they were modified.
+        """
+        if self.cache is None:
+            return
+        for studio_id in studio_ids:
+            if studio_id:
+                self.cache.invalidate('get_nodes_by_ids_complete', studio_id)
+
+
+
+class RequestStats(object):
+    """
+    Thread-safe counters of the requests made by a `StudioApi` for each endpoint:
+    number of requests, latency histogram, response bytes, retries, and cache
+    hits. Use `as_dict` to read them, or `save_json`/`save_prometheus` to dump.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.endpoints = {}   # endpoint name --> dict of counters
+        self.lock = threading.Lock()
+
+    def _get_counters(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                'requests': 0,
+                'latency_sum': 0.0,
+                'latency_buckets': [0] * len(self.buckets),   # non-cumulative counts
+                'bytes': 0,
+                'retries': 0,
+                'cache_hits': 0,
+            }
+        return self.endpoints[endpoint]
+
+    def record_request(self, endpoint, latency, num_bytes):
+        with self.lock:
+            counters = self._get_counters(endpoint)
+            counters['requests'] += 1
+            counters['latency_sum'] += latency
+            counters['bytes'] += num_bytes
+            for i, bucket in enumerate(self.buckets):
+                if latency <= bucket:
+                    counters['latency_buckets'][i] += 1
+                    break
+
+    def record_retry(self, endpoint):
+        with self.lock:
+            self._get_counters(endpoint)['retries'] += 1
+
+    def record_cache_hit(self, endpoint):
+        with self.lock:
+            self._get_counters(endpoint)['cache_hits'] += 1
+
+    def as_dict(self):
+        """
+        Returns a dict of endpoint name --> dict of counters, with the latency
+        histogram as a dict of bucket upper bound (seconds) --> count.
+        """
+        with self.lock:
+            stats = {}
+            for endpoint, counters in self.endpoints.items():
+                endpoint_stats = dict(counters)
+                endpoint_stats['latency_buckets'] = dict(
+                    (str(bucket), count) for bucket, count in zip(self.buckets, counters['latency_buckets']))
+                stats[endpoint] = endpoint_stats
+            return stats
+
+    def save_json(self, path):
+        with open(path, 'w') as jsonf:
+            json.dump(self.as_dict(), jsonf, indent=2)
+
+    def to_prometheus(self):
+        """
+        Returns the counters in the Prometheus text exposition format.
+        """
+        lines = [
+            '# TYPE studio_api_requests_total counter',
+            '# TYPE studio_api_request_duration_seconds histogram',
+            '# TYPE studio_api_response_bytes_total counter',
+            '# TYPE studio_api_retries_total counter',
+            '# TYPE studio_api_cache_hits_total counter',
+        ]
+        with self.lock:
+            for endpoint, counters in sorted(self.endpoints.items()):
+                label = 'endpoint="{}"'.format(endpoint)
+                lines.append('studio_api_requests_total{%s} %d' % (label, counters['requests']))
+                cumulative_count = 0
+                for bucket, count in zip(self.buckets, counters['latency_buckets']):
+                    cumulative_count += count
+                    le = '+Inf' if bucket == float('inf') else str(bucket)
+                    lines.append('studio_api_request_duration_seconds_bucket{%s,le="%s"} %d' % (label, le, cumulative_count))
+                lines.append('studio_api_request_duration_seconds_sum{%s} %f' % (label, counters['latency_sum']))
+                lines.append('studio_api_request_duration_seconds_count{%s} %d' % (label, counters['requests']))
+                lines.append('studio_api_response_bytes_total{%s} %d' % (label, counters['bytes']))
+                lines.append('studio_api_retries_total{%s} %d' % (label, counters['retries']))
+                lines.append('studio_api_cache_hits_total{%s} %d' % (label, counters['cache_hits']))
+        return '\n'.join(lines) + '\n'
+
+    def save_prometheus(self, path):
+        with open(path, 'w') as promf:
+            promf.write(self.to_prometheus())
+
+
+
+class RateLimiter(object):
+    """
+    Thread-safe token bucket rate limiter that allows `rate` calls per second on
+    average, and bursts of up to `burst` calls.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then consume it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+
+class MutationBatcher(object):
+    """
+    Queue of pending edits, deletes, and copies of Studio nodes that are sent
+    in batches of `batch_size` nodes per request when `flush` is called:
+      - edits are grouped into PUT requests to /api/contentnode
+      - deletes are grouped by channel into moves to the channel's trash tree
+      - copies are grouped by channel and target parent
+    Usage:
+        batcher = MutationBatcher(studio_api)
+        for node in nodes:
+            node['tags'].append('newtag')
+            batcher.put(node)
+        results = batcher.flush()
+    """
+
+    def __init__(self, studio_api, batch_size=MUTATIONS_BATCH_SIZE):
+        self.studio_api = studio_api
+        self.batch_size = batch_size
+        self.pending = {}  # (action, channel_id, target_parent) --> list of node datas
 
+    def put(self, data):
+        self._add(('put', None, None), data)
 
+    def delete(self, data, channel_id):
+        self._add(('delete', channel_id, None), data)
+
+    def copy(self, data, target_parent, channel_id):
+        self._add(('copy', channel_id, target_parent), data)
+
+    def _add(self, group_key, data):
+        self.pending.setdefault(group_key, []).append(data)
+
+    def __len__(self):
+        return sum(len(datas) for datas in self.pending.values())
+
+    def flush(self):
+        """
+        Send all pending mutations and return a list of per-node results, which
+        are dicts with keys `id`, `action`, `ok` (bool), `status_code`, `data`
+        (node data returned by Studio when available), and `error` (exception
+        raised while sending the node's batch, if any). A failed batch doesn't
+        stop the flush; its nodes are reported with `ok=False`.
+        """
+        results = []
+        pending, self.pending = self.pending, {}
+        for (action, channel_id, target_parent), datas in pending.items():
+            for batch in split_into_chunks(datas, self.batch_size):
+                LOGGER.info('  {} batch of {} nodes'.format(action, len(batch)))
+                try:
+                    if action == 'put':
+                        response = self.studio_api.put_contentnodes(batch)
+                    elif action == 'delete':
+                        trash_studio_id = self.studio_api.get_trash_tree_id(channel_id)
+                        response = self.studio_api.move_contentnodes(batch, trash_studio_id, channel_id)
+                    else:
+                        response = self.studio_api.duplicate_contentnodes(batch, target_parent, channel_id)
+                except Exception as e:
+                    LOGGER.error('  {} batch of {} nodes failed: {}'.format(action, len(batch), repr(e)))
+                    results.extend(self._get_batch_error_results(action, batch, e))
+                    continue
+                results.extend(self._get_batch_results(action, batch, response))
+        return results
+
+    def _get_batch_error_results(self, action, batch, error):
+        return [{'id': data.get('id'), 'action': action, 'ok': False, 'status_code': None,
+                 'data': None, 'error': error} for data in batch]
+
+    def _get_batch_results(self, action, batch, response):
+        """
+        Returns the per-node results of a batch. When Studio returns the list of
+        nodes it changed, a node is `ok` only if it is in that list: edited and
+        moved nodes are matched by `id`, and copies by `source_node_id` (the
+        `node_id` of the node copied), or by position if the copies have no
+        source ids. The `data` of a copy is the new node, with the new `id`.
+        """
+        status_ok = response.status_code in [200, 201]
+        try:
+            response_data = response.json()
+        except ValueError:
+            response_data = None
+        has_node_list = status_ok and isinstance(response_data, list)
+        if has_node_list:
+            returned_datas = [returned_data for returned_data in response_data if isinstance(returned_data, dict)]
+            if action == 'copy':
+                matched_datas = self._match_copies(batch, returned_datas)
+            else:
+                returned_by_id = dict((returned_data.get('id'), returned_data) for returned_data in returned_datas)
+                matched_datas = [returned_by_id.get(data['id']) for data in batch]
+        else:
+            matched_datas = [None] * len(batch)
+        batch_results = []
+        for data, matched_data in zip(batch, matched_datas):
+            batch_results.append({
+                'id': data['id'],
+                'action': action,
+                'ok': matched_data is not None if has_node_list else status_ok,
+                'status_code': response.status_code,
+                'data': matched_data,
+                'error': None,
+            })
+        return batch_results
+
+    def _match_copies(self, batch, copies):
+        """
+        Returns the list of copies in `copies` (nodes returned by Studio) for
+        each node in `batch`, or None for the nodes that were not copied.
+        """
+        copies_by_source = {}
+        for copy_data in copies:
+            for source_key in ['source_node_id', 'original_source_node_id']:
+                if copy_data.get(source_key):
+                    copies_by_source.setdefault(copy_data[source_key], []).append(copy_data)
+                    break
+        if not copies_by_source and len(copies) == len(batch):
+            return list(copies)
+        matched_datas = []
+        for data in batch:
+            same_source_copies = copies_by_source.get(data.get('node_id'))
+            matched_datas.append(same_source_copies.pop(0) if same_source_copies else None)
+        return matched_datas
+
+
+
+class ResponseCache(object):
+    """
+    SQLite-backed cache for Studio API JSON responses keyed by `endpoint` and
+    `key` (usually the id of the channel or node). Entries are stored under
+    `namespace` (the studio_url of the client) so clients of different Studio
+    servers can share the same cache file without seeing each other's data. Entries older than `ttl`
+    seconds are returned as not fresh so the caller can revalidate them, and
+    least recently used entries are evicted when the total size of the cached
+    responses goes above `max_bytes`.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, namespace=''):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                endpoint TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                body TEXT NOT NULL,
+                                etag TEXT,
+                                last_modified TEXT,
+                                fetched_at REAL NOT NULL,
+                                accessed_at REAL NOT NULL,
+                                size INTEGER NOT NULL,
+                                PRIMARY KEY (endpoint, key))""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _endpoint(self, endpoint):
+        return self.namespace + ' ' + endpoint if self.namespace else endpoint
+
+    def get(self, endpoint, key):
+        """
+        Returns a dict with the cached `data`, its `etag` and `last_modified`
+        headers, and `fresh` (True if younger than ttl), or None if not cached.
+        """
+        endpoint = self._endpoint(endpoint)
+        with self.lock:
+            row = self.conn.execute('SELECT body, etag, last_modified, fetched_at FROM responses '
+                                    'WHERE endpoint=? AND key=?', (endpoint, key)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.conn.execute('UPDATE responses SET accessed_at=? WHERE endpoint=? AND key=?',
+                              (now, endpoint, key))
+            self.conn.commit()
+        body, etag, last_modified, fetched_at = row
+        return {
+            'data': json.loads(body),
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': now - fetched_at < self.ttl,
+        }
+
+    def set(self, endpoint, key, data, etag=None, last_modified=None):
+        endpoint = self._endpoint(endpoint)
+        body = json.dumps(data)
+        size = len(body)
+        now = time.time()
+        with self.lock:
+            old_row = self.conn.execute('SELECT size FROM responses WHERE endpoint=? AND key=?',
+                                        (endpoint, key)).fetchone()
+            if old_row:
+                self.total_bytes -= old_row[0]
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (endpoint, key, body, etag, last_modified, now, now, size))
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def touch(self, endpoint, key):
+        """
+        Mark the entry as fresh again after a successful revalidation (304).
+        """
+        endpoint = self._endpoint(endpoint)
+        now = time.time()
+        with self.lock:
+            self.conn.execute('UPDATE responses SET fetched_at=?, accessed_at=? WHERE endpoint=? AND key=?',
+                              (now, now, endpoint, key))
+            self.conn.commit()
+
+    def invalidate(self, endpoint, key):
+        endpoint = self._endpoint(endpoint)
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE endpoint=? AND key=?',
+                                    (endpoint, key)).fetchone()
+            if row:
+                self.conn.execute('DELETE FROM responses WHERE endpoint=? AND key=?', (endpoint, key))
+                self.total_bytes -= row[0]
+                self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM responses')
+            self.conn.commit()
+            self.total_bytes = 0
+
+    def _evict(self):
+        """
+        Delete least recently used entries until the cache is 10% below budget.
+        Must be called with `self.lock` held.
+        """
+        target_bytes = int(self.max_bytes * 0.9)
+        rows = self.conn.execute('SELECT endpoint, key, size FROM responses ORDER BY accessed_at').fetchall()
+        evicted = []
+        for endpoint, key, size in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            evicted.append((endpoint, key))
+            self.total_bytes -= size
+        self.conn.executemany('DELETE FROM responses WHERE endpoint=? AND key=?', evicted)
+        LOGGER.info('Evicted {} entries from response cache {}'.format(len(evicted), self.path))
+
+
+
+def create_pooled_session(pool_size=POOL_SIZE):
+    """
+    Returns a `requests` session that keeps alive up to `pool_size` connections
+    per host and accepts gzip-compressed responses.
+    """
+    session = requests.session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+def get_endpoint_name(url):
+    """
+    Returns the name of the Studio API endpoint for `url` without the ids, e.g.
+    `get_nodes_by_ids_complete` for `{studio_url}/api/get_nodes_by_ids_complete/a,b`.
+    """
+    path = urlparse(url).path
+    if '/api/' in path:
+        return path.split('/api/', 1)[1].split('/')[0]
+    return path.strip('/')
+
+def get_backoff_delay(attempt, retry_after=None):
+    """
+    Return how long to wait before retry number `attempt` (starting from 0).
+    Uses the server's `Retry-After` header if present, otherwise full-jitter
+    exponential backoff capped at `BACKOFF_MAX` seconds.
+    """
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass  # HTTP-date format not supported; fall back to backoff
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def split_into_chunks(items, chunk_size):
+    """
+    Split the list `items` into a list of lists of length at most `chunk_size`.
+    """
+    return [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
 
 def data_has_required_keys(data, required_keys):
     verdict = True
@@ -0,0 +1,138 @@
+from dateutil.parser import parse
+import logging as LOGGER
+import queue
+import threading
+
+from libnotion import parse_channel_id, update_card_properties
+
+
+STUDIO_WORKERS = 8     # max number of concurrent Studio API fetches
+QUEUE_SIZE = 32        # max number of fetched results waiting to be written
+
+
+# PIPELINE
+################################################################################
+_DONE = object()   # sentinel that tells worker threads to exit
+
+
+def run_pipeline(items, fetch, write, fetch_workers=STUDIO_WORKERS,
+                 write_workers=1, queue_size=QUEUE_SIZE):
+    """
+    Producer/consumer pipeline that calls `fetch(item)` for each of `items` using
+    a pool of `fetch_workers` threads and passes the result to `write(item, result)`
+    running in a separate pool of `write_workers` threads. The two pools are
+    joined by a queue of at most `queue_size` results, so fetchers wait when the
+    writers fall behind. The total time is that of the slower of the two stages.
+    An exception in `fetch` or `write` only affects its item.
+    Returns a list of dicts (in the same order as `items`) with the keys `item`,
+    `ok` (bool), `result` (return value of `write`), `stage`, and `error`.
+    """
+    items = list(items)
+    results = [{'item': item, 'ok': False, 'result': None, 'stage': None, 'error': None}
+               for item in items]
+    todo_queue = queue.Queue()
+    for index in range(len(items)):
+        todo_queue.put(index)
+    for _ in range(fetch_workers):
+        todo_queue.put(_DONE)
+    fetched_queue = queue.Queue(maxsize=queue_size)
+
+    def _record_error(index, stage, error):
+        LOGGER.error('Pipeline {} failed for {}: {}'.format(stage, items[index], repr(error)))
+        results[index]['stage'] = stage
+        results[index]['error'] = error
+
+    def _fetcher():
+        while True:
+            index = todo_queue.get()
+            if index is _DONE:
+                return
+            try:
+                fetched = fetch(items[index])
+            except Exception as e:
+                _record_error(index, 'fetch', e)
+                continue
+            fetched_queue.put((index, fetched))   # blocks when writers are behind
+
+    def _writer():
+        while True:
+            task = fetched_queue.get()
+            if task is _DONE:
+                return
+            index, fetched = task
+            try:
+                results[index]['result'] = write(items[index], fetched)
+                results[index]['ok'] = True
+            except Exception as e:
+                _record_error(index, 'write', e)
+
+    fetchers = [threading.Thread(target=_fetcher) for _ in range(fetch_workers)]
+    writers = [threading.Thread(target=_writer) for _ in range(write_workers)]
+    for thread in fetchers + writers:
+        thread.daemon = True
+        thread.start()
+    for thread in fetchers:
+        thread.join()
+    for _ in range(write_workers):
+        fetched_queue.put(_DONE)
+    for thread in writers:
+        thread.join()
+    return results
+
+
+
+# STUDIO CHANNELS SYNC
+################################################################################
+
+def get_channel_card_values(channel_info_dict):
+    """
+    Returns the dict of "Studio Channels" card property values for the channel
+    info `channel_info_dict` returned by `StudioApi.get_channel`.
+    """
+    new_values = {
+        'is_public': channel_info_dict['public'],
+        'description': channel_info_dict['description'],
+        'version': channel_info_dict['version'],
+        'name': channel_info_dict['name'],
+        'channel_token': channel_info_dict['primary_token'],
+        'last_published': parse(channel_info_dict['created']),
+    }
+    if channel_info_dict.get('staging_tree', None):
+        new_values['has_stage_tree'] = True
+    return new_values
+
+
+def sync_channels_info(notion_channels, client, studio_api, studio_workers=STUDIO_WORKERS):
+    """
+    Update the "Studio Channels" cards `notion_channels` with the latest channel
+    info from Studio, fetching from Studio and writing to Notion concurrently
+    (see `run_pipeline`). The Notion writes are made one at a time by a single
+    writer thread since notion-py keeps the pending operations of a transaction
+    on the `client`. Cards without a channel_id are skipped.
+    Returns `(results, skipped)` where `results` is the list of pipeline results
+    whose items are `(notion_channel, channel_id, channel_name)` tuples and whose
+    `result` is the dict of changed properties, and `skipped` is the list of the
+    names of the cards that were skipped.
+    """
+    cards_to_update = []
+    skipped = []
+    for notion_channel in notion_channels:
+        channel_id = parse_channel_id(notion_channel.get_property('channel_id'))
+        channel_name = notion_channel.get_property('name')
+        if channel_id:
+            cards_to_update.append((notion_channel, channel_id, channel_name))
+        else:
+            skipped.append(channel_name)
+
+    def _fetch_channel_info(card):
+        notion_channel, channel_id, channel_name = card
+        return studio_api.get_channel(channel_id)
+
+    def _update_card(card, channel_info_dict):
+        notion_channel, channel_id, channel_name = card
+        new_values = get_channel_card_values(channel_info_dict)
+        return update_card_properties(notion_channel, new_values, client=client)
+
+    results = run_pipeline(cards_to_update, _fetch_channel_info, _update_card,
+                           fetch_workers=studio_workers, write_workers=1)
+    return results, skipped
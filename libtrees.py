@@ -0,0 +1,368 @@
+from array import array
+import gc
+import hashlib
+import json
+import logging as LOGGER
+import os
+import tracemalloc
+
+
+# TREE SNAPSHOTS
+################################################################################
+# Node attributes that are not part of the content of a node: studio ids and
+# tree structure (differ between main and staging trees) and timestamps.
+DIGEST_IGNORED_FIELDS = [
+    'id',
+    'parent',
+    'children',
+    'tree_id',
+    'sort_order',
+    'created',
+    'modified',
+    'changed',
+    'published',
+    'metadata',
+]
+
+
+def get_node_digest(node):
+    """
+    Returns the sha1 digest of the content attributes of the Studio node `node`.
+    """
+    content = dict((k, v) for k, v in node.items() if k not in DIGEST_IGNORED_FIELDS)
+    content_json = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha1(content_json.encode('utf-8')).hexdigest()
+
+
+def get_node_summary(node):
+    """
+    Returns the sha1 digest of the list of children of `node` and the subtree
+    aggregates (`metadata`) that Studio computes for it (total_count,
+    resource_size, etc.). Used to decide if a subtree must be refetched.
+    """
+    summary = [node.get('children', []), node.get('metadata')]
+    summary_json = json.dumps(summary, sort_keys=True, default=str)
+    return hashlib.sha1(summary_json.encode('utf-8')).hexdigest()
+
+
+def make_snapshot_entry(node, parent_id):
+    return {
+        'key': node.get('node_id') or node['id'],
+        'title': node.get('title'),
+        'kind': node.get('kind'),
+        'parent_id': parent_id,
+        'children': list(node.get('children', [])),
+        'digest': get_node_digest(node),
+        'summary': get_node_summary(node),
+        'subtree_digest': None,   # computed in TreeSnapshot.update_subtree_digests
+    }
+
+
+class TreeSnapshot(object):
+    """
+    Merkle tree summary of a Studio tree rooted at `root_id`. For each node we
+    store its children, a digest of its content, a summary of its children list
+    and Studio-computed subtree metadata, and a `subtree_digest` that combines
+    the node digest with the subtree digests of its children (in order).
+    Use `refresh` to update a snapshot refetching only subtrees that changed
+    and `diff_trees` to compare two snapshots.
+    """
+
+    def __init__(self, root_id, nodes=None):
+        self.root_id = root_id
+        self.nodes = nodes if nodes is not None else {}  # studio_id --> entry dict
+        self.num_copied = 0   # number of entries copied from an older snapshot by `refresh`
+
+    @classmethod
+    def from_tree(cls, tree):
+        """
+        Create a snapshot from a nested tree as returned by `get_tree_for_studio_id`.
+        """
+        snapshot = cls(tree['id'])
+        stack = [(tree, None)]
+        while stack:
+            node, parent_id = stack.pop()
+            child_nodes = node.get('children', [])
+            flat_node = dict(node)
+            if 'children' in node:
+                flat_node['children'] = [child['id'] for child in child_nodes]
+            snapshot.nodes[node['id']] = make_snapshot_entry(flat_node, parent_id)
+            for child in child_nodes:
+                stack.append((child, node['id']))
+        snapshot.update_subtree_digests()
+        return snapshot
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as jsonf:
+            data = json.load(jsonf)
+        return cls(data['root_id'], nodes=data['nodes'])
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as jsonf:
+            json.dump({'root_id': self.root_id, 'nodes': self.nodes}, jsonf)
+        os.replace(tmp_path, path)
+
+    def refresh(self, studio_api, full=False):
+        """
+        Returns a new snapshot with the current state of the tree in Studio.
+        Nodes are fetched one level at a time, and we only descend into nodes
+        whose digest or summary differ from the ones in this snapshot: entries
+        for the subtrees of unchanged nodes are copied from this snapshot without
+        being checked, so edits that don't change the digest or summary of any
+        ancestor (e.g. a leaf title) are missed. The number of copied entries is
+        stored in `num_copied` of the new snapshot. Set `full=True` to refetch all nodes.
+        """
+        new_snapshot = TreeSnapshot(self.root_id)
+        level = studio_api.get_nodes_by_ids([self.root_id], use_cache=False)
+        parent_ids = {self.root_id: None}
+        num_fetched = len(level)
+        while level:
+            child_ids = []
+            for node in level:
+                entry = make_snapshot_entry(node, parent_ids[node['id']])
+                new_snapshot.nodes[node['id']] = entry
+                old_entry = self.nodes.get(node['id'])
+                if not full and old_entry and old_entry['digest'] == entry['digest'] \
+                        and old_entry['summary'] == entry['summary']:
+                    for child_id in entry['children']:
+                        self._copy_subtree(child_id, new_snapshot)
+                else:
+                    for child_id in entry['children']:
+                        parent_ids[child_id] = node['id']
+                        child_ids.append(child_id)
+            level = studio_api.get_nodes_by_ids(child_ids, use_cache=False)
+            num_fetched += len(level)
+        new_snapshot.num_copied = len(new_snapshot.nodes) - num_fetched
+        LOGGER.info('Refreshed tree snapshot {} fetching {} of {} nodes'.format(
+            self.root_id, num_fetched, len(new_snapshot.nodes)))
+        new_snapshot.update_subtree_digests()
+        return new_snapshot
+
+    def _copy_subtree(self, studio_id, new_snapshot):
+        stack = [studio_id]
+        while stack:
+            studio_id = stack.pop()
+            if studio_id not in self.nodes:
+                continue
+            new_snapshot.nodes[studio_id] = dict(self.nodes[studio_id])
+            stack.extend(self.nodes[studio_id]['children'])
+
+    def update_subtree_digests(self):
+        """
+        Compute the `subtree_digest` of all nodes (children before parents).
+        """
+        postorder = []
+        stack = [self.root_id]
+        while stack:
+            studio_id = stack.pop()
+            postorder.append(studio_id)
+            stack.extend(child_id for child_id in self.nodes[studio_id]['children']
+                         if child_id in self.nodes)
+        for studio_id in reversed(postorder):
+            entry = self.nodes[studio_id]
+            sha1 = hashlib.sha1(entry['digest'].encode('utf-8'))
+            for child_id in entry['children']:
+                if child_id in self.nodes:
+                    sha1.update(self.nodes[child_id]['subtree_digest'].encode('utf-8'))
+            entry['subtree_digest'] = sha1.hexdigest()
+
+    def iter_subtree_keys(self, studio_id):
+        stack = [studio_id]
+        while stack:
+            studio_id = stack.pop()
+            entry = self.nodes[studio_id]
+            yield entry['key']
+            stack.extend(child_id for child_id in entry['children'] if child_id in self.nodes)
+
+
+def diff_trees(old_snapshot, new_snapshot):
+    """
+    Compare two tree snapshots and returns a dict with the lists of `added`,
+    `removed`, and `modified` nodes. Nodes are matched by their `node_id`, so
+    this can be used to compare the same tree at two different times, or the
+    main_tree and staging_tree of a channel. Subtrees with the same digest are
+    skipped. A node is modified if its content changed or its children were
+    reordered.
+    """
+    diff = {'added': [], 'removed': [], 'modified': []}
+    stack = [(old_snapshot.root_id, new_snapshot.root_id)]
+    while stack:
+        old_id, new_id = stack.pop()
+        old_entry = old_snapshot.nodes[old_id]
+        new_entry = new_snapshot.nodes[new_id]
+        if old_entry['subtree_digest'] == new_entry['subtree_digest']:
+            continue
+        old_children = [(old_snapshot.nodes[child_id]['key'], child_id)
+                        for child_id in old_entry['children'] if child_id in old_snapshot.nodes]
+        new_children = [(new_snapshot.nodes[child_id]['key'], child_id)
+                        for child_id in new_entry['children'] if child_id in new_snapshot.nodes]
+        old_ids_by_key = dict(old_children)
+        new_ids_by_key = dict(new_children)
+        old_common_keys = [key for key, _ in old_children if key in new_ids_by_key]
+        new_common_keys = [key for key, _ in new_children if key in old_ids_by_key]
+        if old_entry['digest'] != new_entry['digest'] or old_common_keys != new_common_keys:
+            diff['modified'].append(new_entry['key'])
+        for key, child_id in new_children:
+            if key not in old_ids_by_key:
+                diff['added'].extend(new_snapshot.iter_subtree_keys(child_id))
+        for key, child_id in old_children:
+            if key not in new_ids_by_key:
+                diff['removed'].extend(old_snapshot.iter_subtree_keys(child_id))
+        for key in new_common_keys:
+            stack.append((old_ids_by_key[key], new_ids_by_key[key]))
+    return diff
+
+
+
+# COMPACT TREES
+################################################################################
+COMPACT_FIELDS = ['node_id', 'content_id', 'title', 'kind', 'license', 'language']
+INTERNED_FIELDS = ['kind', 'license', 'language']   # few distinct values repeated many times
+
+
+class CompactTree(object):
+    """
+    Memory-efficient columnar representation of a Studio tree for audits of
+    large channels. Nodes are numbered in the order they are added (ordinals),
+    only the attributes in `fields` are kept, each in its own list, and values
+    of `INTERNED_FIELDS` are shared between nodes. Parents and children are
+    looked up by ordinal using arrays of integers instead of nested dicts.
+    """
+
+    def __init__(self, fields=COMPACT_FIELDS):
+        self.fields = list(fields)
+        self.ids = []
+        self.ordinals = {}                 # studio_id --> ordinal
+        self.parents = array('l')          # ordinal of parent, -1 for the root
+        self.columns = dict((field, []) for field in self.fields)
+        self._interned = {}
+        self._child_starts = None          # children index built in `_index_children`
+        self._child_ordinals = None
+
+    @classmethod
+    def from_nodes(cls, nodes, fields=COMPACT_FIELDS):
+        """
+        Build from an iterable of `(node, parent_id, depth)` tuples where parents
+        come before their children, e.g. the output of `StudioApi.iter_tree`,
+        so the full tree never needs to be in memory as dicts.
+        """
+        tree = cls(fields=fields)
+        for node, parent_id, _ in nodes:
+            tree.add_node(node, parent_id)
+        return tree
+
+    @classmethod
+    def from_tree(cls, tree_dict, fields=COMPACT_FIELDS):
+        """
+        Build from a nested tree as returned by `get_tree_for_studio_id`.
+        """
+        def _walk():
+            stack = [(tree_dict, None)]
+            while stack:
+                node, parent_id = stack.pop()
+                yield node, parent_id, None
+                for child in reversed(node.get('children', [])):
+                    stack.append((child, node['id']))
+        return cls.from_nodes(_walk(), fields=fields)
+
+    def add_node(self, node, parent_id):
+        ordinal = len(self.ids)
+        self.ids.append(node['id'])
+        self.ordinals[node['id']] = ordinal
+        self.parents.append(self.ordinals[parent_id] if parent_id is not None else -1)
+        for field in self.fields:
+            value = node.get(field)
+            if field in INTERNED_FIELDS and value is not None:
+                value = self._interned.setdefault(value, value)
+            self.columns[field].append(value)
+        self._child_starts = None
+        return ordinal
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index_of(self, studio_id):
+        return self.ordinals[studio_id]
+
+    def get(self, ordinal, field):
+        return self.columns[field][ordinal]
+
+    def node(self, ordinal):
+        """
+        Returns the node `ordinal` as a dict of the stored fields, plus `id`.
+        """
+        node = dict((field, self.columns[field][ordinal]) for field in self.fields)
+        node['id'] = self.ids[ordinal]
+        return node
+
+    def parent(self, ordinal):
+        """
+        Returns the ordinal of the parent of node `ordinal` (None for the root).
+        """
+        parent = self.parents[ordinal]
+        return parent if parent >= 0 else None
+
+    def children(self, ordinal):
+        """
+        Returns the ordinals of the children of node `ordinal` (in tree order).
+        """
+        if self._child_starts is None:
+            self._index_children()
+        start, end = self._child_starts[ordinal], self._child_starts[ordinal + 1]
+        return self._child_ordinals[start:end]
+
+    def _index_children(self):
+        """
+        Build a compressed children index: the children of node i are stored in
+        `_child_ordinals[_child_starts[i]:_child_starts[i+1]]`.
+        """
+        counts = array('l', [0]) * (len(self.ids) + 1)
+        for parent in self.parents:
+            if parent >= 0:
+                counts[parent + 1] += 1
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        child_ordinals = array('l', [0]) * counts[-1]
+        positions = array('l', counts)
+        for ordinal, parent in enumerate(self.parents):
+            if parent >= 0:
+                child_ordinals[positions[parent]] = ordinal
+                positions[parent] += 1
+        self._child_starts = counts
+        self._child_ordinals = child_ordinals
+
+
+def compare_tree_memory(tree_dict, fields=COMPACT_FIELDS):
+    """
+    Memory benchmark that returns the number of bytes allocated to hold a copy
+    of the nested dicts tree `tree_dict` and to hold its `CompactTree` version.
+    Each version is measured on its own: the CompactTree is built from a
+    separate copy of the dicts that is freed before measuring, so the strings
+    it shares with the dicts are counted.
+    """
+    tree_json = json.dumps(tree_dict)
+    tree_dict = None
+    tracemalloc.start()
+    try:
+        gc.collect()
+        baseline_bytes = tracemalloc.get_traced_memory()[0]
+        dicts_tree = json.loads(tree_json)
+        dicts_bytes = tracemalloc.get_traced_memory()[0] - baseline_bytes
+        del dicts_tree
+        gc.collect()
+        baseline_bytes = tracemalloc.get_traced_memory()[0]
+        dicts_tree = json.loads(tree_json)
+        compact_tree = CompactTree.from_tree(dicts_tree, fields=fields)
+        compact_tree.children(0)  # build children index
+        del dicts_tree
+        gc.collect()
+        compact_bytes = tracemalloc.get_traced_memory()[0] - baseline_bytes
+    finally:
+        tracemalloc.stop()
+    return {
+        'num_nodes': len(compact_tree),
+        'dicts_bytes': dicts_bytes,
+        'compact_bytes': compact_bytes,
+    }